@@ -0,0 +1,93 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Cache of the administrators of each chat, so permission checks don't need a
+getChatAdministrators round trip per command. A chat's admins are loaded on
+its first check, kept up to date by the chat_member updates announcing
+promotions and demotions, and loaded again after ttl seconds in case an
+update was missed.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from telegram import ChatMember, ChatMemberUpdated, TelegramError
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.CREATOR)
+
+
+class AdminCache:
+    """Bounded LRU of chat id -> (set of admin user ids, load time)"""
+
+    def __init__(self, ttl=60 * 60, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.load_errors = 0
+
+    def is_admin(self, bot, chat_id, user_id) -> bool:
+        """True if user_id administers chat_id, loads the admins on a miss"""
+        now = monotonic()
+        with self._lock:
+            entry = self._cache.get(chat_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._cache.move_to_end(chat_id)
+                self.hits += 1
+                return user_id in entry[0]
+
+        admins = self._load(bot, chat_id)
+        if admins is None:
+            return False
+        with self._lock:
+            self._cache[chat_id] = (admins, now)
+            self._cache.move_to_end(chat_id)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return user_id in admins
+
+    def _load(self, bot, chat_id):
+        try:
+            members = bot.get_chat_administrators(chat_id)
+        except TelegramError as e:
+            # Not cached, the next check tries again
+            logger.warning("Loading the admins of %s failed: %s", chat_id, e)
+            self.load_errors += 1
+            return None
+        self.loads += 1
+        return {member.user.id for member in members}
+
+    def member_changed(self, change: ChatMemberUpdated):
+        """Applies a promotion or demotion to the cached admins of its chat"""
+        was_admin = change.old_chat_member.status in ADMIN_STATUSES
+        is_admin = change.new_chat_member.status in ADMIN_STATUSES
+        if was_admin == is_admin:
+            return
+        user_id = change.new_chat_member.user.id
+        with self._lock:
+            entry = self._cache.get(change.chat.id)
+            if entry is None:
+                return
+            admins = entry[0]
+            if is_admin:
+                admins.add(user_id)
+            else:
+                admins.discard(user_id)
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._cache.pop(chat_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,246 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Asyncio execution mode. The handlers stay as they are (they only read the
+store and queue messages), but every call to Telegram they cause - greetings,
+reports, confirmations and deletions - runs as a coroutine on one event loop
+thread. All of them share one pool of keep-alive HTTP connections, so the
+number of requests in flight is limited by the pool and not by a number of
+worker threads.
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import threading
+from urllib.parse import urlsplit
+
+from telegram import Message
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Conflict,
+    InvalidToken,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut,
+    Unauthorized,
+)
+
+from outbox import SendScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    # Keyboards and other telegram objects
+    return value.to_dict()
+
+
+def _result(status, body):
+    """The result of a Bot API response, raising the errors python-telegram-bot would"""
+    try:
+        data = json.loads(body.decode("utf-8", "replace"))
+    except ValueError:
+        raise TelegramError("Invalid server response") from None
+    if 200 <= status <= 299 and data.get("ok"):
+        return data["result"]
+
+    parameters = data.get("parameters") or {}
+    if parameters.get("migrate_to_chat_id"):
+        raise ChatMigrated(parameters["migrate_to_chat_id"])
+    if parameters.get("retry_after"):
+        raise RetryAfter(parameters["retry_after"])
+    message = data.get("description") or "Unknown HTTPError"
+    if status in (401, 403):
+        raise Unauthorized(message)
+    if status == 400:
+        raise BadRequest(message)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(message)
+    if status == 502:
+        raise NetworkError("Bad Gateway")
+    raise NetworkError("%s (%d)" % (message, status))
+
+
+class BotAPI:
+    """
+    Minimal HTTP/1.1 client for the Bot API. url is the API URL including the
+    token, as in Bot.base_url. Idle connections are kept open and reused, at
+    most max_connections requests run at once.
+    """
+
+    def __init__(self, url, max_connections=100, timeout=30.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.path = parts.path.rstrip("/")
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = []
+        self._slots = None
+        self.requests = 0
+        self.connections = 0
+
+    async def call(self, method, params=None):
+        """Calls a Bot API method and returns its result"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        request = self._request(method, params or {})
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    status, body, keep_alive = await asyncio.wait_for(
+                        self._exchange(reader, writer, request), self.timeout
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    writer.close()
+                    raise TimedOut() from None
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    # The server may have closed a connection that was idle
+                    if not reused:
+                        raise NetworkError("%s: %s" % (type(e).__name__, e)) from None
+        self.requests += 1
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return _result(status, body)
+
+    async def close(self):
+        """Closes the idle connections"""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    async def _connect(self):
+        try:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise TimedOut() from None
+        except OSError as e:
+            raise NetworkError("%s: %s" % (type(e).__name__, e)) from None
+        self.connections += 1
+        return connection
+
+    def _request(self, method, params):
+        body = json.dumps(params, default=_encode).encode()
+        head = (
+            "POST %s/%s HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "Content-Type: application/json\r\n"
+            "Content-Length: %d\r\n"
+            "\r\n" % (self.path, method, self.host, len(body))
+        )
+        return head.encode() + body
+
+    @staticmethod
+    async def _exchange(reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+
+        keep_alive = version == b"HTTP/1.1" and headers.get("connection") != "close"
+        return int(status), body, keep_alive
+
+
+class AsyncSendScheduler(SendScheduler):
+    """
+    SendScheduler whose deliveries are coroutines on an event loop thread
+    instead of calls on a pool of worker threads. Queueing, priorities and
+    rate limits are the same.
+    """
+
+    def __init__(self, *args, connections=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = connections
+        self.api = None
+        self.loop = None
+        self._loop_thread = None
+
+    def start(self, bot):
+        """Starts sending through bot's API URL, bot turns results into Messages"""
+        self.api = BotAPI(bot.base_url, self.connections)
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="outbox-loop", daemon=True
+        )
+        self._loop_thread.start()
+        self.bot = bot
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the scheduler, messages still in the queue are discarded"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is None:
+            return
+        self._thread.join()
+        # Let the requests in flight finish
+        self.run(self._drain()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join()
+        self.loop.close()
+
+    def run(self, coroutine):
+        """Runs a coroutine on the scheduler's event loop, returns its future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _drain(self):
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending)
+        await self.api.close()
+
+    def _submit(self, message, seq):
+        self.loop.call_soon_threadsafe(self.loop.create_task, self._deliver_async(message, seq))
+
+    async def _deliver_async(self, message, seq):
+        message.attempts += 1
+        params = dict(message.kwargs, chat_id=message.chat_id, text=message.text)
+        try:
+            result = await self.api.call("sendMessage", params)
+        except Exception as e:
+            self._done(message, seq, error=e)
+            return
+        self._done(message, seq, Message.de_json(result, self.bot))
@@ -0,0 +1,184 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Time ordered queue of messages the bot deletes again. The queue is saved in
+the store, so pending deletions survive a restart, and is drained by one
+periodic job instead of one job per message, which hands the chats that
+have due messages to a small pool of threads.
+"""
+
+import asyncio
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import time
+
+from telegram.error import BadRequest, TelegramError, Unauthorized
+
+logger = logging.getLogger(__name__)
+
+# Telegram refuses to delete messages older than 48 hours
+MAX_AGE = 48 * 60 * 60
+# Longest delay a message may be deleted after, an hour short of MAX_AGE so
+# a deletion that runs late still succeeds
+MAX_TTL = MAX_AGE - 60 * 60
+
+
+class DeletionQueue:
+    """
+    Heap of (due time, chat id, message id). It is saved in buckets of
+    bucket_seconds by due time, <key>:<bucket> -> list of entries, so a save
+    only writes the buckets that changed since the last one.
+    """
+
+    def __init__(self, db, key="autodelete", load=True, workers=8, bucket_seconds=60):
+        self.db = db
+        self.key = key
+        self.workers = workers
+        self.bucket_seconds = bucket_seconds
+        self._executor = None
+        self._heap = []
+        # Bucket number -> set of its entries, and the buckets to save
+        self._buckets = {}
+        self._dirty = set()
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.deleted = 0
+        self.missing = 0
+        if load:
+            self.load()
+
+    def load(self):
+        """
+        Reads the saved queue, adding it to the deletions queued since.
+        Until then save() doesn't overwrite it.
+        """
+        prefix = self.key + ":"
+        entries = []
+        for key, value in self.db.scan(prefix):
+            # Only numbered buckets, not the keys of shards sharing the prefix
+            if key[len(prefix):].isdigit():
+                entries.extend(tuple(entry) for entry in value)
+        # Older versions kept the whole queue under key
+        legacy = [tuple(entry) for entry in self.db.get(self.key) or []]
+        with self._lock:
+            for entry in entries:
+                if self._add(entry, dirty=False):
+                    self._heap.append(entry)
+            for entry in legacy:
+                if self._add(entry):
+                    self._heap.append(entry)
+            heapq.heapify(self._heap)
+            self._loaded = True
+        if legacy:
+            self.save()
+            self.db.rem(self.key)
+
+    def _add(self, entry, dirty=True):
+        """Puts entry into its bucket, returns False if it is there already"""
+        bucket = int(entry[0] // self.bucket_seconds)
+        entries = self._buckets.setdefault(bucket, set())
+        if entry in entries:
+            return False
+        entries.add(entry)
+        if dirty:
+            self._dirty.add(bucket)
+        return True
+
+    def add(self, chat_id, message_id, delay):
+        """Deletes the message after delay seconds"""
+        entry = (time() + delay, chat_id, message_id)
+        with self._lock:
+            if self._add(entry):
+                heapq.heappush(self._heap, entry)
+
+    def pop_due(self, now=None) -> dict:
+        """Removes the messages that are due, grouped by chat"""
+        now = time() if now is None else now
+        due = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                when, chat_id, message_id = entry
+                bucket = int(when // self.bucket_seconds)
+                self._buckets[bucket].discard(entry)
+                self._dirty.add(bucket)
+                if now - when < MAX_AGE:
+                    due.setdefault(chat_id, []).append(message_id)
+        return due
+
+    def save(self):
+        """Writes the buckets that changed to the store"""
+        with self._lock:
+            if not self._loaded:
+                return
+            for bucket in self._dirty:
+                key = "%s:%d" % (self.key, bucket)
+                entries = self._buckets.get(bucket)
+                if entries:
+                    self.db.set(key, sorted(entries))
+                else:
+                    self._buckets.pop(bucket, None)
+                    self.db.rem(key)
+            self._dirty.clear()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def run(self, bot):
+        """Deletes every message that is due, the chats on several threads"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="autodelete")
+        futures = [
+            self._executor.submit(self._delete, bot, chat_id, message_ids)
+            for chat_id, message_ids in self.pop_due().items()
+        ]
+        wait(futures)
+        self.save()
+
+    def _delete(self, bot, chat_id, message_ids):
+        for message_id in message_ids:
+            try:
+                bot.delete_message(chat_id, message_id)
+                with self._lock:
+                    self.deleted += 1
+            except TelegramError as e:
+                if self._failed(chat_id, message_ids, message_id, e):
+                    break
+
+    def stop(self):
+        """Waits for the running deletions and stops the threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def run_async(self, api):
+        """Deletes every message that is due through an aiobot.BotAPI, chats concurrently"""
+
+        async def delete(chat_id, message_ids):
+            for message_id in message_ids:
+                try:
+                    await api.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+                    self.deleted += 1
+                except TelegramError as e:
+                    if self._failed(chat_id, message_ids, message_id, e):
+                        break
+
+        await asyncio.gather(*(delete(c, m) for c, m in self.pop_due().items()))
+        self.save()
+
+    def _failed(self, chat_id, message_ids, message_id, error) -> bool:
+        """Books a failed deletion, returns True if the chat's other messages can be skipped"""
+        if isinstance(error, BadRequest):
+            # Someone was faster, or the bot lost its admin rights
+            with self._lock:
+                self.missing += 1
+            logger.debug("Can't delete %s in %s: %s", message_id, chat_id, error.message)
+        elif isinstance(error, Unauthorized):
+            # The bot left the chat, the other messages are gone too
+            with self._lock:
+                self.missing += len(message_ids)
+            return True
+        else:
+            logger.warning("Deleting %s in %s failed: %s", message_id, chat_id, error.message)
+        return False
@@ -0,0 +1,56 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Buffers the members joining or leaving a chat during a short window, so one
+message can greet (or say goodbye to) all of them.
+"""
+
+import threading
+
+JOIN = "join"
+LEAVE = "leave"
+
+
+class MemberBuffer:
+    """
+    Members waiting to be greeted, per (chat id, JOIN/LEAVE). Only the first
+    limit names are kept, the rest are just counted.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, kind, name) -> bool:
+        """
+        Buffers a member. Returns True if this opened a new window, in that
+        case the caller has to schedule the flush.
+        """
+        with self._lock:
+            entry = self._pending.get((chat_id, kind))
+            if entry is None:
+                self._pending[(chat_id, kind)] = [[name], 1]
+                return True
+            if len(entry[0]) < self.limit:
+                entry[0].append(name)
+            entry[1] += 1
+            return False
+
+    def pop(self, chat_id, kind):
+        """Closes the window, returns the kept names and the number of members"""
+        with self._lock:
+            return self._pending.pop((chat_id, kind), ([], 0))
+
+    def __len__(self):
+        with self._lock:
+            return sum(count for _, count in self._pending.values())
+
+
+def join_names(names, count) -> str:
+    """'A, B and C', or 'A, B +N others' if count is larger than len(names)"""
+    if count > len(names):
+        return "%s +%d others" % (", ".join(names), count - len(names))
+    if len(names) == 1:
+        return names[0]
+    return "%s and %s" % (", ".join(names[:-1]), names[-1])
@@ -0,0 +1,78 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Sends the same burst of messages through the threaded SendScheduler and the
+AsyncSendScheduler against a local fake Bot API that answers every request
+after a fixed latency. Rate limits are lifted, so the only limit left is how
+many requests each mode can have in flight.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_asyncio [--messages 2000] [--latency 0.05]
+"""
+
+import argparse
+import threading
+from time import perf_counter
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from aiobot import AsyncSendScheduler
+from benchmarks.fake_bot_api import FakeBotAPI
+from outbox import SendScheduler
+
+UNLIMITED = dict(
+    global_rate=1e9,
+    group_rate=1e9,
+    group_burst=1e9,
+    private_rate=1e9,
+    private_burst=1e9,
+    max_queue=10 ** 6,
+)
+
+
+def measure(scheduler, bot, messages, chats):
+    done = threading.Semaphore(0)
+    finished = lambda *args: done.release()
+
+    scheduler.start(bot)
+    start = perf_counter()
+    for number in range(messages):
+        scheduler.send(-1000 - number % chats, "Hello!", on_sent=finished, on_error=finished)
+    for _ in range(messages):
+        done.acquire()
+    elapsed = perf_counter() - start
+    threads = threading.active_count()
+    scheduler.stop()
+    return elapsed, threads, scheduler.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency).start()
+    print(
+        "%d messages to %d chats, %.0f ms per request\n"
+        % (args.messages, args.chats, args.latency * 1000)
+    )
+    print("%-28s %9s %10s %8s %7s" % ("mode", "seconds", "msg/s", "threads", "failed"))
+
+    runs = [("threads, %d workers" % n, SendScheduler, {"workers": n}) for n in (4, 32, 128)]
+    runs += [("asyncio, %d connections" % n, AsyncSendScheduler, {"connections": n}) for n in (100, 1000)]
+    for name, cls, options in runs:
+        workers = options.get("workers", 1)
+        bot = Bot("123:ABC", base_url=api.url, request=Request(con_pool_size=workers))
+        elapsed, threads, stats = measure(cls(**UNLIMITED, **options), bot, args.messages, args.chats)
+        print(
+            "%-28s %9.2f %10.0f %8d %7d"
+            % (name, elapsed, args.messages / elapsed, threads, stats["failed"])
+        )
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Compares rendering a precompiled Template with the old chain of str.replace
+calls greet_chat_members used to run for every join.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_templates
+"""
+
+import timeit
+from html import escape
+
+from templates import Template
+
+MESSAGE = (
+    "Hello $username! Welcome to <b>$title</b>.$n$nPlease read the pinned "
+    "message before posting, introduce yourself and check the rules at "
+    "https://example.org/rules.$n$n" * 3 + "Have fun, $username!"
+)
+USERNAME = "Alice <3"
+TITLE = "Python & Friends"
+NUMBER = 200000
+
+
+def replace_chain():
+    text = MESSAGE
+    text = text.replace("$username", USERNAME)
+    text = text.replace("$title", TITLE)
+    text = text.replace("$n", "\n")
+    return text
+
+
+def replace_chain_escaped():
+    text = MESSAGE
+    text = text.replace("$username", escape(USERNAME, False))
+    text = text.replace("$title", escape(TITLE, False))
+    text = text.replace("$n", "\n")
+    return text
+
+
+def main():
+    template = Template(MESSAGE)
+
+    results = [
+        ("str.replace chain", timeit.timeit(replace_chain, number=NUMBER)),
+        (
+            "escaped replace chain",
+            timeit.timeit(replace_chain_escaped, number=NUMBER),
+        ),
+        (
+            "Template.render",
+            timeit.timeit(lambda: template.render(USERNAME, TITLE), number=NUMBER),
+        ),
+        (
+            "Template() + render",
+            timeit.timeit(lambda: Template(MESSAGE).render(USERNAME, TITLE), number=NUMBER),
+        ),
+    ]
+    for name, seconds in results:
+        print("%-22s %8.1f ns/message" % (name, seconds / NUMBER * 1e9))
+
+
+if __name__ == "__main__":
+    main()
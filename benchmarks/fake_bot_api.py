@@ -0,0 +1,303 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Stand-in for the Telegram Bot API on localhost, so the bot can be measured
+without Telegram. It speaks HTTP/1.1 with keep-alive and implements what the
+bot uses: getMe, getUpdates (long polling), setWebhook/deleteWebhook (then
+updates are posted to the webhook instead), sendMessage, deleteMessage and
+getChatAdministrators (the user ids in admins[chat_id]).
+
+    api = FakeBotAPI(latency=0.05, retry_after_rate=0.01).start()
+    bot = Bot("123:ABC", base_url=api.url)
+    api.push_updates([{"chat_member": {...}}])
+
+Faults are injected into sendMessage: with retry_after_rate a message is
+refused with 429 and retry_after seconds. Chats in blocked, and a share of
+blocked_rate of all chats, refuse messages as if the bot was blocked or
+kicked.
+Chats in exempt never fail.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import threading
+from collections import deque
+from time import time
+from urllib.parse import urlsplit
+
+BOT_USER = {"id": 123, "is_bot": True, "first_name": "Welcome", "username": "welcome_bot"}
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        retry_after_rate=0.0,
+        retry_after=1,
+        blocked=(),
+        blocked_rate=0.0,
+        webhook_connections=40,
+        seed=0,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.blocked_rate = blocked_rate
+        self.exempt = set()
+        # chat id -> user ids of its admins
+        self.admins = {}
+        self._contacted = set()
+        self.webhook_connections = webhook_connections
+        self.random = random.Random(seed)
+
+        self.requests = {}
+        # (time, chat id, text) of every message sent
+        self.sent = []
+        self.deleted = []
+        self.rate_limited = 0
+        self.refused = 0
+        self.webhook = None
+        self.webhook_secret = None
+
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._updates = deque()
+        self._new_updates = None
+        self._webhook_task = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL to pass to the bot, the token is appended to it"""
+        return "http://%s:%d/bot" % (self.host, self.port)
+
+    def start(self):
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, args=(started,), name="fake-bot-api", daemon=True
+        )
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _close(self):
+        self._server.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def push_updates(self, updates):
+        """Queues updates for the bot, numbering them, from any thread"""
+        self._loop.call_soon_threadsafe(self._push, list(updates))
+
+    def pending(self) -> int:
+        """Number of updates the bot hasn't fetched (or been sent) yet"""
+        return len(self._updates)
+
+    def _push(self, updates):
+        for update in updates:
+            self._updates.append(dict(update, update_id=next(self._update_ids)))
+        self._new_updates.set()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._new_updates = asyncio.Event()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._serve, self.host, self.port, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                target = request_line.split()[1].decode()
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                params = json.loads(await reader.readexactly(length) or b"{}")
+
+                status, response = await self.handle(target.rsplit("/", 1)[-1], params)
+                body = json.dumps(response).encode()
+                writer.write(
+                    b"HTTP/1.1 %d -\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (status, len(body), body)
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, method, params):
+        """Returns the status and JSON body answering a Bot API call"""
+        method = method.lower()
+        self.requests[method] = self.requests.get(method, 0) + 1
+        if self.latency and method != "getupdates":
+            await asyncio.sleep(self.latency)
+        handler = getattr(self, "api_" + method, None)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        try:
+            result = handler(params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except _Error as e:
+            return e.status, e.response
+        return 200, {"ok": True, "result": result}
+
+    def api_getme(self, params):
+        return BOT_USER
+
+    async def api_getupdates(self, params):
+        if self.webhook:
+            raise _Error(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Updates before offset are confirmed
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    def api_setwebhook(self, params):
+        self.webhook = params.get("url") or None
+        self.webhook_secret = params.get("secret_token")
+        if self.webhook and self._webhook_task is None:
+            self._webhook_task = asyncio.ensure_future(self._post_updates())
+        return True
+
+    def api_deletewebhook(self, params):
+        self.webhook = None
+        if params.get("drop_pending_updates"):
+            self._updates.clear()
+        self._new_updates.set()
+        return True
+
+    def api_sendmessage(self, params):
+        chat_id = int(params["chat_id"])
+        if chat_id not in self.exempt:
+            self._inject_faults(chat_id)
+
+        self.sent.append((time(), chat_id, params["text"]))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": BOT_USER,
+            "text": params["text"],
+        }
+
+    def _inject_faults(self, chat_id):
+        if self.retry_after_rate and self.random.random() < self.retry_after_rate:
+            self.rate_limited += 1
+            raise _Error(
+                429,
+                "Too Many Requests: retry after %d" % self.retry_after,
+                {"retry_after": self.retry_after},
+            )
+        if chat_id not in self._contacted:
+            self._contacted.add(chat_id)
+            if self.blocked_rate and self.random.random() < self.blocked_rate:
+                self.blocked.add(chat_id)
+        if chat_id in self.blocked:
+            self.refused += 1
+            if chat_id > 0:
+                raise _Error(403, "Forbidden: bot was blocked by the user")
+            raise _Error(403, "Forbidden: bot was kicked from the supergroup chat")
+
+    def api_getchatadministrators(self, params):
+        return [
+            {
+                "user": {"id": user_id, "is_bot": False, "first_name": "u%d" % user_id},
+                "status": "administrator",
+                "can_be_edited": False,
+                "is_anonymous": False,
+            }
+            for user_id in self.admins.get(int(params["chat_id"]), ())
+        ]
+
+    def api_deletemessage(self, params):
+        self.deleted.append((int(params["chat_id"]), int(params["message_id"])))
+        return True
+
+    async def _post_updates(self):
+        """Posts queued updates to the webhook, retrying refused ones after a second"""
+        slots = asyncio.Semaphore(self.webhook_connections)
+
+        async def post(update):
+            try:
+                while self.webhook and not await self._post(update):
+                    await asyncio.sleep(1)
+            finally:
+                slots.release()
+
+        while self.webhook:
+            if not self._updates:
+                self._new_updates.clear()
+                await self._new_updates.wait()
+                continue
+            update = self._updates.popleft()
+            await slots.acquire()
+            asyncio.ensure_future(post(update))
+        self._webhook_task = None
+
+    async def _post(self, update) -> bool:
+        url = urlsplit(self.webhook)
+        body = json.dumps(update).encode()
+        headers = "POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n" % (
+            url.path or "/",
+            url.hostname,
+        )
+        if self.webhook_secret:
+            headers += "X-Telegram-Bot-Api-Secret-Token: %s\r\n" % self.webhook_secret
+        headers += "Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body)
+        try:
+            reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+            writer.write(headers.encode() + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            writer.close()
+            return status_line.split()[1:2] == [b"200"]
+        except (OSError, IndexError):
+            return False
+
+
+class _Error(Exception):
+    def __init__(self, status, description, parameters=None):
+        super().__init__(description)
+        self.status = status
+        self.response = {"ok": False, "error_code": status, "description": description}
+        if parameters:
+            self.response["parameters"] = parameters
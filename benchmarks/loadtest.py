@@ -0,0 +1,284 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Load test of the whole bot. welcome.py runs as a separate process against
+the fake Bot API, which replays a storm of updates to it:
+
+    raid     --joins users join --chats groups at the same moment
+    leaves   as many members leave again
+    groups   the bot is added to --groups groups at once
+
+Reported are how fast the bot worked through the storm, the latency from a
+join (or leave) to the message that greeted it and the memory of the bot
+process. Unless --unlimited is given the bot keeps to Telegram's flood
+limits, so greetings in a raided group trickle out at 20 per minute.
+
+Usage (from the repository root):
+    python -m benchmarks.loadtest raid --joins 2000 --chats 20 --unlimited
+    python -m benchmarks.loadtest raid --joins 5000 --batch 3
+    python -m benchmarks.loadtest groups --groups 10000 --lanes 4
+    python -m benchmarks.loadtest leaves --latency 0.05 --retry-after-rate 0.01 --asyncio
+"""
+
+import argparse
+import itertools
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep, time
+
+from benchmarks.fake_bot_api import BOT_USER, FakeBotAPI
+
+WELCOME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "welcome.py")
+TOKEN = "123:ABC"
+# The user who adds the bot to every group
+ADMIN = {"id": 1, "is_bot": False, "first_name": "Admin"}
+FIRST_GROUP = -1001000000000
+# Markers are new users every time, the bot drops a member joining twice
+MARKER_USERS = itertools.count(1)
+
+# Members are called u<id>, batched greetings end in "+N others"
+NAMES = re.compile(r"\bu\d+\b")
+OTHERS = re.compile(r"\+(\d+) others")
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": "u%d" % user_id}
+
+
+def member_update(chat_id, member, old, new, kind="chat_member", by=None):
+    return {
+        kind: {
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Group %d" % -chat_id},
+            "from": by or member,
+            "date": int(time()),
+            "old_chat_member": {"user": member, "status": old},
+            "new_chat_member": {"user": member, "status": new},
+        }
+    }
+
+
+def bot_added(chat_id):
+    return member_update(chat_id, BOT_USER, "left", "member", "my_chat_member", ADMIN)
+
+
+def command(chat_id, text):
+    name = text.split()[0]
+    return {
+        "message": {
+            "message_id": 1,
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Group %d" % -chat_id},
+            "from": ADMIN,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(name)}],
+        }
+    }
+
+
+def scenario(args):
+    """Returns the setup updates, the storm and the chat of every member in it"""
+    groups = [FIRST_GROUP - number for number in range(args.chats)]
+    setup = [bot_added(chat_id) for chat_id in groups]
+    if args.batch:
+        setup += [command(chat_id, "/batch %d" % args.batch) for chat_id in groups]
+
+    if args.scenario == "groups":
+        groups = [FIRST_GROUP - number for number in range(args.groups)]
+        return [], [bot_added(chat_id) for chat_id in groups], []
+
+    old, new = ("left", "member") if args.scenario == "raid" else ("member", "left")
+    storm, members = [], []
+    for number in range(args.joins):
+        chat_id = groups[number % len(groups)]
+        storm.append(member_update(chat_id, user(10000 + number), old, new))
+        members.append(chat_id)
+    return setup, storm, members
+
+
+def markers(lanes):
+    """One join per lane, handled once everything queued before it is"""
+    return [
+        member_update(-lane, user(next(MARKER_USERS)), "left", "member")
+        for lane in range(1, lanes + 1)
+    ]
+
+
+def wait_for(condition, timeout, process):
+    deadline = monotonic() + timeout
+    while not condition():
+        if process.poll() is not None:
+            sys.exit("The bot exited, see its log")
+        if monotonic() > deadline:
+            return False
+        sleep(0.02)
+    return True
+
+
+def run_phase(api, updates, lanes, process, timeout):
+    """Pushes updates followed by markers, returns the start and end time"""
+    marker_chats = set(range(-lanes, 0))
+    start = time()
+    api.push_updates(updates + markers(lanes))
+
+    def markers_greeted():
+        return marker_chats <= {chat_id for when, chat_id, text in api.sent if when >= start}
+
+    if not wait_for(markers_greeted, timeout, process):
+        sys.exit("The bot didn't finish within %d seconds" % timeout)
+    end = max(when for when, chat_id, text in api.sent if chat_id in marker_chats)
+    return start, end
+
+
+def latencies(api, start, members, timeout, process):
+    """Waits until every member was greeted, returns the latency of each greeting"""
+    # Messages answering the members of each chat, in order
+    pending = {}
+    for chat_id in members:
+        pending[chat_id] = pending.get(chat_id, 0) + 1
+    result = []
+    position = 0
+
+    def collect():
+        nonlocal position
+        sent = api.sent
+        while position < len(sent):
+            when, chat_id, text = sent[position]
+            position += 1
+            if when < start or not pending.get(chat_id):
+                continue
+            covered = len(NAMES.findall(text)) + sum(map(int, OTHERS.findall(text)))
+            covered = min(covered, pending[chat_id])
+            pending[chat_id] -= covered
+            result.extend([when - start] * covered)
+        # Chats that refuse messages are never greeted
+        return not any(count and chat_id not in api.blocked for chat_id, count in pending.items())
+
+    wait_for(collect, timeout, process)
+    return sorted(result)
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def memory(pid):
+    """Current and peak resident memory of a process in MB, None if unknown"""
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            fields = dict(line.split(":", 1) for line in status)
+    except OSError:
+        return None, None
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_bot(args, api, workdir, log):
+    env = dict(
+        os.environ,
+        WELCOME_TOKEN=TOKEN,
+        WELCOME_BASE_URL=api.url,
+        WELCOME_DATABASE=args.database,
+    )
+    if args.unlimited:
+        env.update(WELCOME_SEND_GLOBAL_RATE="1000000", WELCOME_SEND_GROUP_RATE="1000000")
+    command = [sys.executable, WELCOME, "--lanes", str(args.lanes)]
+    if args.asyncio:
+        command.append("--asyncio")
+    if args.webhook:
+        port = free_port()
+        command += ["--webhook", "--port", str(port)]
+        command += ["--webhook-url", "http://127.0.0.1:%d/telegram" % port]
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=log)
+
+    if args.webhook:
+        ready = lambda: api.webhook is not None
+    else:
+        ready = lambda: api.requests.get("getupdates")
+    if not wait_for(ready, 30, process):
+        sys.exit("The bot didn't start, see its log")
+    return process
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of welcome.py")
+    parser.add_argument("scenario", choices=["raid", "leaves", "groups"])
+    parser.add_argument("--joins", type=int, default=2000, help="members joining or leaving")
+    parser.add_argument("--chats", type=int, default=10, help="groups they join or leave")
+    parser.add_argument("--groups", type=int, default=10000, help="groups the bot is added to")
+    parser.add_argument("--batch", type=int, default=0, help="batch greetings for that many seconds")
+    parser.add_argument("--unlimited", action="store_true", help="lift the bot's flood limits")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API request")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="share of chats refusing messages")
+    parser.add_argument("--lanes", type=int, default=1)
+    parser.add_argument("--asyncio", action="store_true")
+    parser.add_argument("--webhook", action="store_true")
+    parser.add_argument("--database", default="bot.db", help="e.g. sqlite:bot.sqlite3")
+    parser.add_argument("--timeout", type=int, default=300, help="seconds to wait for the bot")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    api = FakeBotAPI(
+        latency=args.latency,
+        retry_after_rate=args.retry_after_rate,
+        blocked_rate=args.blocked_rate,
+    ).start()
+    api.exempt.update(range(-args.lanes, 0))
+
+    workdir = tempfile.mkdtemp(prefix="welcome-loadtest-")
+    log_path = os.path.join(workdir, "bot.log")
+    setup, storm, members = scenario(args)
+    with open(log_path, "w") as log:
+        process = start_bot(args, api, workdir, log)
+        try:
+            if setup:
+                run_phase(api, setup, args.lanes, process, args.timeout)
+            rss_before, _ = memory(process.pid)
+            start, end = run_phase(api, storm, args.lanes, process, args.timeout)
+            greeted = latencies(api, start, members, args.timeout, process)
+            rss, peak = memory(process.pid)
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    api.stop()
+
+    mode = "webhook" if args.webhook else "polling"
+    print(
+        "%s: %d updates, %s, %d lane(s), %s"
+        % (args.scenario, len(storm), mode, args.lanes, "asyncio" if args.asyncio else "threads")
+    )
+    print("processed  %.2f s, %.0f updates/s" % (end - start, len(storm) / (end - start)))
+    if members:
+        if greeted:
+            print(
+                "greeted    %d/%d, latency p50 %.3f s, p99 %.3f s"
+                % (len(greeted), len(members), percentile(greeted, 0.5), percentile(greeted, 0.99))
+            )
+        else:
+            print("greeted    0/%d" % len(members))
+    print(
+        "api        %d sent, %d deleted, %d rate limited, %d refused"
+        % (len(api.sent), len(api.deleted), api.rate_limited, api.refused)
+    )
+    if rss is not None:
+        print("memory     %.1f MB, peak %.1f MB, %.1f MB before the storm" % (rss, peak, rss_before))
+    print("bot log    %s" % log_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Sends one message to every chat of a registry. The registry is read page by
+page and every page is queued on the send scheduler at the lowest priority,
+so the flood limits hold and greetings still go first. After a page is done
+the position is saved in the store, a broadcast that was interrupted resumes
+with the page it was on (chats of that page may get the message twice).
+"""
+
+import logging
+import threading
+from time import monotonic, time
+
+import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcast:
+    """
+    The broadcast state lives in the store under key:
+    {"text", "by", "cursor", "total", "sent", "failed", "removed", "started"}.
+    on_failed(chat_id, error) is called for every message that couldn't be
+    sent and returns True if the chat was removed from the registry.
+    on_progress(by, text) receives a progress report every report_interval
+    seconds and when the broadcast ends, by is who started it.
+    """
+
+    def __init__(
+        self,
+        db,
+        registry,
+        sender,
+        key="broadcast",
+        page_size=100,
+        on_failed=None,
+        on_progress=None,
+        report_interval=60,
+    ):
+        self.db = db
+        self.registry = registry
+        self.sender = sender
+        self.key = key
+        self.page_size = page_size
+        self.on_failed = on_failed
+        self.on_progress = on_progress
+        self.report_interval = report_interval
+        self._cond = threading.Condition()
+        self._pending = 0
+        # Messages per second of the running broadcast
+        self.rate = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def state(self):
+        """The saved state of the unfinished broadcast, None if there is none"""
+        return self.db.get(self.key) or None
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text=None, by=None) -> bool:
+        """
+        Starts sending text in a background thread, or resumes the saved
+        broadcast without text. Returns False if a broadcast is unfinished
+        (when text is given) or there is nothing to resume.
+        """
+        if self.running():
+            return False
+        if text is not None:
+            if self.state is not None:
+                return False
+            self.db.set(
+                self.key,
+                {
+                    "text": text,
+                    "by": by,
+                    "cursor": None,
+                    "total": len(self.registry),
+                    "sent": 0,
+                    "failed": 0,
+                    "removed": 0,
+                    "started": time(),
+                },
+            )
+        elif self.state is None:
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="broadcast", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, wait=True):
+        """Pauses the broadcast after the current page, it resumes with start()"""
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def cancel(self) -> bool:
+        """Stops the broadcast and forgets it"""
+        self.stop()
+        if self.state is None:
+            return False
+        self.db.rem(self.key)
+        return True
+
+    def run(self):
+        """Sends the saved broadcast in the calling thread until it is done or stopped"""
+        state = self.state
+        if state is None:
+            return
+        logger.info("Broadcasting to %d chats, %d done", state["total"], self.done(state))
+        # Throughput is measured from here, a resumed broadcast starts over
+        start, start_done = monotonic(), self.done(state)
+        reported = start
+        self.rate = None
+        while True:
+            rows, cursor = self.registry.page(state["cursor"], self.page_size)
+            results = self._send_page(state, rows)
+            if results is None:
+                # Stopped halfway through, the page is sent again on resume
+                logger.info("Broadcast paused, %d chats done", self.done(state))
+                return
+            state["sent"] += results["sent"]
+            state["failed"] += results["failed"]
+            state["removed"] += results["removed"]
+            state["cursor"] = cursor
+            if cursor is None:
+                break
+            self.db.set(self.key, state)
+
+            now = monotonic()
+            self.rate = (self.done(state) - start_done) / (now - start)
+            if now - reported >= self.report_interval:
+                reported = now
+                self._report(state, self.progress(state))
+            if self._stop.is_set():
+                logger.info("Broadcast paused, %d chats done", self.done(state))
+                return
+
+        self.db.rem(self.key)
+        elapsed = time() - state["started"]
+        self._report(
+            state,
+            "Broadcast finished in %d s: sent to %d chats, %d failed, %d removed"
+            % (elapsed, state["sent"], state["failed"], state["removed"])
+        )
+
+    def _send_page(self, state, rows):
+        """
+        Queues one message per chat and waits until all of them are done.
+        Returns the counts, None if the broadcast was stopped while the
+        queue was full.
+        """
+        results = {"sent": 0, "failed": 0, "removed": 0}
+
+        def sent(message):
+            with self._cond:
+                results["sent"] += 1
+                self._pending -= 1
+                self._cond.notify()
+
+        def failed(chat_id, error):
+            removed = False
+            if self.on_failed is not None:
+                try:
+                    removed = self.on_failed(chat_id, error)
+                except Exception:
+                    logger.exception("Broadcast error callback for chat %s failed", chat_id)
+            with self._cond:
+                results["failed"] += 1
+                results["removed"] += bool(removed)
+                self._pending -= 1
+                self._cond.notify()
+
+        complete = True
+        for chat_id, row in rows:
+            with self._cond:
+                self._pending += 1
+            # The queue is full, wait for the scheduler to catch up
+            while not self.sender.send(
+                chat_id, state["text"], outbox.BROADCAST, on_sent=sent, on_error=failed
+            ):
+                if self._stop.wait(1):
+                    complete = False
+                    with self._cond:
+                        self._pending -= 1
+                    break
+            if not complete:
+                break
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+        return results if complete else None
+
+    def _report(self, state, text):
+        logger.info(text)
+        if self.on_progress is not None:
+            try:
+                self.on_progress(state["by"], text)
+            except Exception:
+                logger.exception("Broadcast progress callback failed")
+
+    @staticmethod
+    def done(state) -> int:
+        return state["sent"] + state["failed"]
+
+    def progress(self, state=None) -> str:
+        """Describes how far the broadcast is, with throughput and ETA while it runs"""
+        state = state or self.state
+        rate = self.rate if self.running() else None
+        if state is None:
+            return "No broadcast is running"
+        done = self.done(state)
+        total = max(state["total"], done)
+        text = "Broadcast: %d/%d chats, %d failed, %d removed" % (
+            done,
+            total,
+            state["failed"],
+            state["removed"],
+        )
+        if rate:
+            eta = (total - done) / rate
+            text += ", %.1f msg/s, ETA " % rate
+            text += "%d s" % eta if eta < 120 else "%d min" % (eta / 60 + 0.5)
+        elif not self.running():
+            text += " (paused)"
+        return text
@@ -0,0 +1,149 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Drops updates that were already handled, before any handler touches the
+store or sends a message. Two things are checked:
+
+- update ids: the last size ids are kept in a ring buffer, which is saved
+  in the store, so updates Telegram delivers again after a restart (or a
+  retried getUpdates or webhook call) are recognized.
+- membership events: for every (chat, user, joined or left) the date of the
+  last event is kept. An event that isn't newer is a replay. With a
+  flap_window, a member joining again (or leaving again) within that many
+  seconds of the previous join (or leave) isn't greeted twice either. The
+  bot's own membership is only checked for replays, a flapping group must
+  still be registered correctly.
+"""
+
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Reasons an update is dropped
+DUPLICATE = "duplicate"
+REPLAY = "replay"
+FLAP = "flap"
+
+
+class UpdateFilter:
+    """
+    status_change(chat_member_updated) returns (was member, is member) or
+    None, like extract_status_change() in welcome.py.
+    """
+
+    def __init__(
+        self,
+        status_change,
+        db=None,
+        key="dedup",
+        size=4096,
+        flap_window=10,
+        max_members=100000,
+    ):
+        self.status_change = status_change
+        self.db = db
+        self.key = key
+        self.size = size
+        self.flap_window = flap_window
+        self.max_members = max_members
+        self._ids = deque()
+        self._id_set = set()
+        # (chat id, user id, joined) -> date of the last event, oldest first
+        self._members = OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.dropped = {DUPLICATE: 0, REPLAY: 0, FLAP: 0}
+
+    def load(self):
+        """
+        Reads the saved update ids, adding them to the ones seen since.
+        Updates accepted before it are only checked against those.
+        """
+        if self.db is None:
+            return
+        with self._lock:
+            for update_id in self.db.get(self.key) or []:
+                self._remember(update_id)
+
+    def save(self):
+        """Writes the update ids to the store if new ones were seen"""
+        with self._lock:
+            if self.db is None or not self._dirty:
+                return
+            self.db.set(self.key, list(self._ids))
+            self._dirty = False
+
+    def accept(self, update: Update) -> bool:
+        """False if the update was handled before and should be dropped"""
+        with self._lock:
+            if update.update_id in self._id_set:
+                return self._drop(DUPLICATE, update)
+            self._remember(update.update_id)
+            self._dirty = True
+
+            if update.chat_member is not None:
+                reason = self._check_member(update.chat_member, self.flap_window)
+            elif update.my_chat_member is not None:
+                reason = self._check_member(update.my_chat_member, 0)
+            else:
+                return True
+            if reason is not None:
+                return self._drop(reason, update)
+        return True
+
+    def _remember(self, update_id):
+        if update_id in self._id_set:
+            return
+        if len(self._ids) >= self.size:
+            self._id_set.discard(self._ids.popleft())
+        self._ids.append(update_id)
+        self._id_set.add(update_id)
+
+    def _check_member(self, change, flap_window):
+        """Returns why a membership event is dropped, None to handle it"""
+        result = self.status_change(change)
+        if result is None:
+            return None
+        was_member, is_member = result
+        if was_member == is_member:
+            return None
+
+        date = change.date.timestamp()
+        key = (change.chat.id, change.new_chat_member.user.id, is_member)
+        last = self._members.get(key)
+        self._expire(date)
+        if last is not None:
+            if date <= last:
+                return REPLAY
+            if date - last < flap_window:
+                # Counted from the first event, a member joining every few
+                # seconds is greeted once per window
+                return FLAP
+        self._members[key] = date
+        self._members.move_to_end(key)
+        if len(self._members) > self.max_members:
+            self._members.popitem(last=False)
+        return None
+
+    def _expire(self, now):
+        # Events older than the flap window only matter for replays, which
+        # the update ids catch as well
+        horizon = now - max(self.flap_window, 60)
+        while self._members:
+            key, date = next(iter(self._members.items()))
+            if date >= horizon:
+                break
+            self._members.popitem(last=False)
+
+    def _drop(self, reason, update):
+        self.dropped[reason] += 1
+        logger.debug("Dropped update %s (%s)", update.update_id, reason)
+        return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.dropped, update_ids=len(self._ids), members=len(self._members))
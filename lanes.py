@@ -0,0 +1,95 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Dispatcher that processes updates on several threads ("lanes"). Updates are
+assigned to a lane by their chat id, so all updates of one chat are still
+handled one after another and in order, while a slow chat only holds up the
+chats sharing its lane.
+"""
+
+import logging
+import threading
+from queue import Queue
+from time import monotonic
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def lane_key(update) -> int:
+    """The id updates are hashed by: the chat, else the user, else 0"""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return 0
+
+
+class LaneDispatcher(Dispatcher):
+    """
+    The dispatcher thread only routes updates into the lanes. Each lane
+    holds at most max_backlog updates; when one is full the router waits,
+    which in turn makes the update queue (and the webhook) push back.
+    """
+
+    def __init__(self, *args, lanes=4, max_backlog=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane_count = lanes
+        self.max_backlog = max_backlog
+        self._lanes = []
+        self._threads = []
+        self._processed = [0] * lanes
+        self._last_warning = 0.0
+
+    def start(self, ready=None):
+        self._lanes = [Queue(self.max_backlog) for _ in range(self.lane_count)]
+        self._threads = [
+            threading.Thread(target=self._run_lane, args=(number, lane), name="lane-%d" % number)
+            for number, lane in enumerate(self._lanes)
+        ]
+        for thread in self._threads:
+            thread.start()
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        # Let the lanes finish what was routed to them, their writes and
+        # sends must happen before the store and the sender are closed
+        for lane in self._lanes:
+            lane.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def process_update(self, update):
+        if not self._lanes:
+            super().process_update(update)
+            return
+        number = lane_key(update) % self.lane_count
+        lane = self._lanes[number]
+        if lane.qsize() >= self.max_backlog // 2 and monotonic() - self._last_warning > 60:
+            self._last_warning = monotonic()
+            logger.warning("Lane %d is falling behind (%d updates waiting)", number, lane.qsize())
+        lane.put(update)
+
+    def _run_lane(self, number, lane):
+        while True:
+            update = lane.get()
+            if update is _STOP:
+                break
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception("Processing an update in lane %d failed", number)
+            self._processed[number] += 1
+
+    def lane_stats(self) -> list:
+        """Backlog and number of processed updates of every lane"""
+        return [
+            {"lane": number, "backlog": lane.qsize(), "processed": self._processed[number]}
+            for number, lane in enumerate(self._lanes)
+        ]
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Garbage collection and integrity check of the store. Removing a chat only
+removes its registry row, its settings (<chat_id>, <chat_id>_bye, ...) stay
+behind. A chat whose row went missing while the bot is still in it (e.g.
+after a send error) is registered again on its next activity, so only an
+explicit leave marks a chat for collection. A maintenance run walks the
+whole store page by page and
+
+- drops the settings of chats the bot left more than a grace period ago,
+  unless it joined them again,
+- removes users who blocked the bot from the report lists,
+- checks every key against the schema in welcome.py and reports the keys
+  and values that don't fit (they are left alone),
+- recounts the registries and repairs wrong counts,
+- rewrites the store into a fresh, compact file, atomically (unless
+  rewrite is off, e.g. for a database several instances share, which is
+  better rewritten offline).
+
+It runs as a job in the bot, or offline while the bot is stopped:
+    python maintenance.py [--dry-run] bot.db
+"""
+
+import argparse
+import logging
+import re
+import sys
+from time import perf_counter, time
+
+import storage
+from registry import ChatRegistry
+from settings import FIELDS
+
+logger = logging.getLogger(__name__)
+
+# <chat_id><suffix>, the settings of a chat
+SETTING_KEY = re.compile(
+    r"(-?\d+)(%s)?$" % "|".join(suffix for suffix in FIELDS.values() if suffix)
+)
+# Registry rows
+ROW_KEY = re.compile(r"(chat|user|channel|blocked|left):-?\d+$")
+# Keys of the whole bot, per shard when sharded
+GLOBAL_KEY = re.compile(
+    r"(chat_count|user_count|channel_count|blocked_count|left_count|autodelete|broadcast|dedup)"
+    r"(:.+)?$"
+)
+
+# Settings key suffix -> whether a value fits it
+VALID_SETTINGS = {
+    "": lambda value: isinstance(value, str),
+    "_bye": lambda value: value is None or isinstance(value, str),
+    "_adm": lambda value: isinstance(value, int),
+    "_lck": lambda value: isinstance(value, bool),
+    "_quiet": lambda value: isinstance(value, bool),
+    "_title": lambda value: value is None or isinstance(value, str),
+    "_reports": lambda value: isinstance(value, list)
+    and all(isinstance(user_id, int) for user_id in value),
+    "_batch": lambda value: isinstance(value, int),
+    "_ttl": lambda value: isinstance(value, int),
+}
+ROW_FIELDS = {"type", "title", "joined", "seen"}
+
+# Problems logged per run, the rest is only counted
+MAX_LOGGED = 20
+
+# Seconds after leaving a chat its settings are kept, in case the bot is
+# added again
+GRACE_PERIOD = 7 * 24 * 60 * 60
+
+
+class Maintenance:
+    """
+    chats is the registry of the chats the bot is in, left the registry of
+    the chats it left, blocked the registry of users who blocked the bot.
+    registries are recounted unless they are sharded. on_changed(chat_id)
+    is called for every chat whose settings were changed or dropped.
+    """
+
+    def __init__(
+        self,
+        db,
+        chats,
+        left,
+        blocked,
+        registries=(),
+        page_size=1000,
+        on_changed=None,
+        grace_period=GRACE_PERIOD,
+        rewrite=True,
+    ):
+        self.db = db
+        self.chats = chats
+        self.left = left
+        self.blocked = blocked
+        self.registries = registries
+        self.grace_period = grace_period
+        self.rewrite = rewrite
+        self.page_size = page_size
+        self.on_changed = on_changed
+        self._running = False
+
+        self.runs = 0
+        self.removed_keys = 0
+        self.unsubscribed = 0
+        self.invalid_keys = 0
+        self.recounted = 0
+        self.seconds = 0.0
+
+    def run(self, dry_run=False) -> dict:
+        """
+        Runs once and returns what it found. With dry_run nothing is
+        changed. Returns None if another run is still going on.
+        """
+        if self._running:
+            return None
+        self._running = True
+        try:
+            return self._run(dry_run)
+        finally:
+            self._running = False
+
+    def _run(self, dry_run):
+        start = perf_counter()
+        report = {"keys": 0, "removed_keys": 0, "unsubscribed": 0, "invalid_keys": 0}
+        report["recounted"] = 0
+        # Only the blocks and leaves known now are handled, later ones wait
+        # for the next run
+        blocked = {user_id for user_id, row in self.blocked}
+        now = time()
+        expired = {
+            chat_id for chat_id, row in self.left if now - row["seen"] > self.grace_period
+        }
+        orphans = set()
+        # Whether the settings of the previous key's chat are dropped, a
+        # chat's keys mostly follow each other
+        last_chat, orphaned = None, False
+
+        for key, value in self.db.iter_items(self.page_size):
+            report["keys"] += 1
+            match = SETTING_KEY.match(key)
+            if match is not None:
+                chat_id, suffix = int(match.group(1)), match.group(2) or ""
+                if not self._check_setting(key, suffix, value, report):
+                    continue
+                if chat_id != last_chat:
+                    last_chat, orphaned = chat_id, self._orphaned(chat_id, expired)
+                if orphaned:
+                    orphans.add(chat_id)
+                    self._remove_orphan(chat_id, key, dry_run, report)
+                elif suffix == "_reports" and blocked.intersection(value):
+                    self._unsubscribe(chat_id, key, value, blocked, dry_run, report)
+            elif ROW_KEY.match(key):
+                if not (isinstance(value, dict) and ROW_FIELDS <= value.keys()):
+                    self._invalid(key, value, report)
+            elif not GLOBAL_KEY.match(key):
+                self._invalid(key, value, report)
+
+        if not dry_run:
+            for registry in self.registries:
+                if registry.shard is None and registry.recount():
+                    report["recounted"] += 1
+            for user_id in blocked:
+                self.blocked.remove(user_id)
+            for chat_id in expired:
+                self.left.remove(chat_id)
+            if self.rewrite:
+                self.db.rewrite()
+
+        report["orphaned_chats"] = len(orphans)
+        seconds = perf_counter() - start
+        if not dry_run:
+            self.runs += 1
+            self.removed_keys += report["removed_keys"]
+            self.unsubscribed += report["unsubscribed"]
+            self.invalid_keys += report["invalid_keys"]
+            self.recounted += report["recounted"]
+            self.seconds += seconds
+        logger.info(
+            "Maintenance%s: %d keys in %.1f s, removed %d keys of %d chats, %d subscribers,"
+            " %d invalid keys, %d counts repaired",
+            " (dry run)" if dry_run else "",
+            report["keys"],
+            seconds,
+            report["removed_keys"],
+            report["orphaned_chats"],
+            report["unsubscribed"],
+            report["invalid_keys"],
+            report["recounted"],
+        )
+        return report
+
+    def _orphaned(self, chat_id, expired) -> bool:
+        # Another shard may have registered the chat again since it was
+        # cached here
+        return chat_id in expired and self.chats.get(chat_id, cached=False) is None
+
+    def _check_setting(self, key, suffix, value, report) -> bool:
+        # False is what the store returns for unset keys, it may be stored too
+        if value is False or VALID_SETTINGS[suffix](value):
+            return True
+        self._invalid(key, value, report)
+        return False
+
+    def _invalid(self, key, value, report):
+        report["invalid_keys"] += 1
+        if report["invalid_keys"] <= MAX_LOGGED:
+            logger.warning("Unexpected key or value in the store: %r = %.100r", key, value)
+
+    def _remove_orphan(self, chat_id, key, dry_run, report):
+        report["removed_keys"] += 1
+        if dry_run:
+            return
+        self.db.rem(key)
+        self._changed(chat_id)
+
+    def _unsubscribe(self, chat_id, key, value, blocked, dry_run, report):
+        # The walk may be behind the store, don't drop who subscribed since
+        value = self.db.get(key) or []
+        subscribers = [user_id for user_id in value if user_id not in blocked]
+        report["unsubscribed"] += len(value) - len(subscribers)
+        if dry_run:
+            return
+        self.db.set(key, subscribers)
+        self._changed(chat_id)
+
+    def _changed(self, chat_id):
+        if self.on_changed is not None:
+            self.on_changed(chat_id)
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "removed_keys": self.removed_keys,
+            "unsubscribed": self.unsubscribed,
+            "invalid_keys": self.invalid_keys,
+            "recounted": self.recounted,
+            "seconds": self.seconds,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clean up the store of a stopped bot")
+    parser.add_argument("database", help="e.g. bot.db or sqlite:bot.sqlite3")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    db = storage.open_store(args.database)
+    chats = ChatRegistry(db)
+    registries = [
+        chats,
+        ChatRegistry(db, "user:", "user_count"),
+        ChatRegistry(db, "channel:", "channel_count"),
+    ]
+    left = ChatRegistry(db, "left:", "left_count")
+    blocked = ChatRegistry(db, "blocked:", "blocked_count")
+    if db.scan("chat_count:"):
+        # Shards keep their own counts, which can't be told apart offline
+        registries = []
+    else:
+        registries += [left, blocked]
+    Maintenance(db, chats, left, blocked, registries).run(args.dry_run)
+    db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Metrics in the Prometheus text format. Handlers are timed with @timed, all
+other numbers are counters the bot's components already keep; they are read
+through callbacks when /metrics is scraped, so they cost nothing until then.
+"""
+
+import bisect
+import functools
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, handlers take anything from microseconds (only
+# memory touched) to a network round trip
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield "%s%s %s" % (self.name, _labels(self.labels, labels), _number(value))
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above all buckets, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[position] += 1
+            counts[-1] += value
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s histogram" % self.name
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = 'le="%s"' % _number(bound)
+                yield "%s_bucket%s %d" % (self.name, _labels(self.labels, labels, le), total)
+            yield "%s_sum%s %s" % (self.name, _labels(self.labels, labels), _number(counts[-1]))
+            yield "%s_count%s %d" % (self.name, _labels(self.labels, labels), total)
+
+
+class Callback:
+    """
+    A value read when the metrics are scraped. func returns a number, or a
+    dict of label value tuples to numbers if labels are given.
+    """
+
+    def __init__(self, name, help, func, type="gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.labels = tuple(labels)
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s %s" % (self.name, self.type)
+        values = sorted(value.items()) if self.labels else [((), value)]
+        for labels, number in values:
+            yield "%s%s %s" % (self.name, _labels(self.labels, labels), _number(number))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric %s already exists" % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, func, type="gauge", labels=()) -> Callback:
+        return self._add(Callback(name, help, func, type, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception("Collecting %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+handler_seconds = REGISTRY.histogram(
+    "welcome_handler_seconds", "Time spent in handlers and jobs", ["handler"]
+)
+handler_errors = REGISTRY.counter(
+    "welcome_handler_errors_total", "Handlers and jobs that raised an exception", ["handler"]
+)
+
+
+def timed(func):
+    """Records how long every call of func takes, and whether it raised"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(perf_counter() - start, name)
+
+    return wrapper
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "WelcomeBot"
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MetricsServer:
+    """Serves GET /metrics, for when the bot polls and has no webhook server"""
+
+    def __init__(self, registry=REGISTRY, listen="127.0.0.1", port=9090):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.registry = self.registry
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="metrics", daemon=True
+        )
+        self._thread.start()
+        logger.info("Serving metrics on %s:%d/metrics", self.listen, self.port)
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
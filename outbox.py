@@ -0,0 +1,286 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Central send scheduler. Every message the bot sends is queued here and
+released through token buckets: one for the whole bot (Telegram allows about
+30 messages per second) and one per chat (about 20 messages per minute in a
+group). Higher priority messages (lower numbers) go first, RetryAfter errors
+pause the bucket of the affected chat.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Priorities
+GREETING = 0
+REPORT = 0
+NOTICE = 1
+CONFIRMATION = 2
+BROADCAST = 3
+
+
+class TokenBucket:
+    """Allows rate events per second, with bursts of up to capacity events"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now) -> float:
+        """Seconds until the next token is available, 0 if there is one"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        """Hands out no tokens for the given number of seconds"""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    def idle(self, now) -> bool:
+        return now >= self.paused_until and self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class _Message:
+    __slots__ = ("chat_id", "text", "priority", "kwargs", "on_sent", "on_error", "attempts")
+
+    def __init__(self, chat_id, text, priority, kwargs, on_sent, on_error):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.on_error = on_error
+        self.attempts = 0
+
+
+class SendScheduler:
+    """
+    Priority queue of outgoing messages. One thread hands messages whose
+    buckets have a token to a small pool of workers that do the HTTP calls.
+    """
+
+    def __init__(
+        self,
+        global_rate=30,
+        group_rate=20 / 60,
+        group_burst=3,
+        private_rate=1,
+        private_burst=3,
+        workers=4,
+        max_queue=10000,
+        max_attempts=3,
+    ):
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        # Called as on_error(chat_id, exception) when a message without its
+        # own error callback can't be sent
+        self.on_error = None
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []
+        self._deferred = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._executor = None
+        self.bot = None
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = {}
+
+    def start(self, bot):
+        """Starts sending with the given bot"""
+        self.bot = bot
+        self._running = True
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the scheduler, messages still in the queue are discarded"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+
+    def send(
+        self,
+        chat_id,
+        text,
+        priority=CONFIRMATION,
+        on_sent=None,
+        on_error=None,
+        **kwargs
+    ) -> bool:
+        """
+        Queues a message. on_sent is called with the sent Message, on_error
+        with the exception if sending failed. Returns False if the queue is
+        full.
+        """
+        message = _Message(chat_id, text, priority, kwargs, on_sent, on_error)
+        with self._cond:
+            if len(self._ready) + len(self._deferred) >= self.max_queue:
+                self._drop(message)
+                return False
+            heapq.heappush(self._ready, (priority, next(self._seq), message))
+            self._cond.notify()
+        return True
+
+    def stats(self) -> dict:
+        """Queue depth and counters"""
+        with self._cond:
+            return {
+                "queued": len(self._ready),
+                "deferred": len(self._deferred),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "rate_limited": self.rate_limited,
+                "dropped": sum(self.dropped.values()),
+                "dropped_by_priority": dict(self.dropped),
+            }
+
+    def _drop(self, message):
+        self.dropped[message.priority] = self.dropped.get(message.priority, 0) + 1
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self, now):
+        # Full buckets behave exactly like new ones
+        for chat_id in [c for c, b in self._chats.items() if b.idle(now)]:
+            del self._chats[chat_id]
+
+    def _run(self):
+        with self._cond:
+            while self._running:
+                now = monotonic()
+                while self._deferred and self._deferred[0][0] <= now:
+                    _, seq, message = heapq.heappop(self._deferred)
+                    heapq.heappush(self._ready, (message.priority, seq, message))
+
+                if not self._ready:
+                    timeout = self._deferred[0][0] - now if self._deferred else None
+                    if len(self._chats) > 10000:
+                        self._prune_buckets(now)
+                    self._cond.wait(timeout)
+                    continue
+
+                wait = self._global.delay(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+
+                _, seq, message = heapq.heappop(self._ready)
+                bucket = self._bucket(message.chat_id)
+                wait = bucket.delay(now)
+                if wait:
+                    heapq.heappush(self._deferred, (now + wait, seq, message))
+                    continue
+
+                bucket.take(now)
+                self._global.take(now)
+                self._submit(message, seq)
+
+    def _submit(self, message, seq):
+        """Hands a message that may go out now to a worker"""
+        self._executor.submit(self._deliver, message, seq)
+
+    def _deliver(self, message, seq):
+        message.attempts += 1
+        try:
+            sent = self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except Exception as e:
+            self._done(message, seq, error=e)
+            return
+        self._done(message, seq, sent)
+
+    def _done(self, message, seq, sent=None, error=None):
+        """Books the outcome of a delivery attempt"""
+        if isinstance(error, RetryAfter):
+            logger.warning(
+                "Flood limit hit in chat %s, pausing it for %s seconds",
+                message.chat_id,
+                error.retry_after,
+            )
+            with self._cond:
+                self.rate_limited += 1
+                now = monotonic()
+                self._bucket(message.chat_id).pause(error.retry_after, now)
+                if message.attempts < self.max_attempts:
+                    self.retried += 1
+                    heapq.heappush(self._deferred, (now + error.retry_after, seq, message))
+                    self._cond.notify()
+                    return
+                self._drop(message)
+            self._failed(message, error)
+            return
+        if error is not None:
+            self._failed(message, error)
+            return
+
+        with self._cond:
+            self.sent += 1
+        if message.on_sent is not None:
+            try:
+                message.on_sent(sent)
+            except Exception:
+                logger.exception("on_sent callback for chat %s failed", message.chat_id)
+
+    def _failed(self, message, error):
+        with self._cond:
+            self.failed += 1
+        callback = message.on_error or self.on_error
+        if callback is None:
+            logger.error("Sending to chat %s failed: %s", message.chat_id, error)
+            return
+        try:
+            callback(message.chat_id, error)
+        except Exception:
+            logger.exception("on_error callback for chat %s failed", message.chat_id)
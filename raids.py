@@ -0,0 +1,97 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Detects raids, many members joining a chat within a short time. Every chat
+keeps the times of its last threshold joins in a ring buffer. A join that
+comes less than window seconds after the join threshold places before it
+starts (or extends) a raid, which lasts until no such spike was seen for
+cooldown seconds. A join is checked in O(1). Chats are forgotten once their
+joins can't matter anymore, and at most max_chats are tracked.
+"""
+
+import threading
+from array import array
+from collections import OrderedDict
+from time import monotonic
+
+# What join() returns
+NORMAL = 0
+STARTED = 1
+ONGOING = 2
+
+
+class _Ring:
+    __slots__ = ("times", "position", "last", "until")
+
+    def __init__(self, size):
+        self.times = array("d", [float("-inf")]) * size
+        self.position = 0
+        self.last = 0.0
+        self.until = 0.0
+
+
+class RaidDetector:
+    def __init__(self, threshold=10, window=10, cooldown=60, max_chats=100000):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.max_chats = max_chats
+        # Ordered by the last join
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+        self.raids = 0
+        self.raid_joins = 0
+
+    def join(self, chat_id, now=None) -> int:
+        """
+        Records a join, returns STARTED if it started a raid, ONGOING during
+        a raid and NORMAL otherwise. A threshold of 0 never detects a raid.
+        """
+        if not self.threshold:
+            return NORMAL
+        now = monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            ring = self._chats.get(chat_id)
+            if ring is None:
+                ring = self._chats[chat_id] = _Ring(self.threshold)
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+
+            oldest = ring.times[ring.position]
+            ring.times[ring.position] = now
+            ring.position = (ring.position + 1) % self.threshold
+            ring.last = now
+
+            if now - oldest < self.window:
+                state = STARTED if now >= ring.until else ONGOING
+                ring.until = now + self.cooldown
+                if state == STARTED:
+                    self.raids += 1
+            elif now < ring.until:
+                state = ONGOING
+            else:
+                return NORMAL
+            self.raid_joins += 1
+            return state
+
+    def _expire(self, now):
+        # A chat whose last join is older than the window and whose raid is
+        # over behaves exactly like one that was never seen
+        while self._chats:
+            ring = next(iter(self._chats.values()))
+            if now - ring.last < self.window or now < ring.until:
+                break
+            self._chats.popitem(last=False)
+
+    def raided(self, chat_id, now=None) -> bool:
+        """True while a chat is in raid mode"""
+        now = monotonic() if now is None else now
+        with self._lock:
+            ring = self._chats.get(chat_id)
+            return ring is not None and now < ring.until
+
+    def __len__(self):
+        return len(self._chats)
@@ -0,0 +1,189 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Registries of the chats the bot is a member of. Every chat is its own row in
+the store, <prefix><chat_id> -> {"type", "title", "joined", "seen"}, so
+adding, removing and looking up a chat costs O(1), a change is written as a
+single key and a registry can be read page by page. Nothing is loaded up
+front.
+"""
+
+import threading
+from time import monotonic, time
+
+
+# Last activity is written at most this often per chat
+TOUCH_INTERVAL = 60 * 60
+# How long the counts of the other shards are reused
+SHARD_COUNT_INTERVAL = 10
+
+
+class ChatRegistry:
+    """
+    With a shard id, several instances share the store. Each one keeps its
+    own <count_key>:<shard> and the length is the sum of all of them.
+    """
+
+    def __init__(self, db, prefix="chat:", count_key="chat_count", shard=None):
+        self.db = db
+        self.prefix = prefix
+        self.count_key = count_key
+        self.shard = shard
+        self._own_count_key = count_key + ":" + shard if shard else count_key
+        self._others = 0
+        self._others_read = None
+        # Changes whenever a chat is added, removed or renamed
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def migrate(self, key):
+        """Converts an old list of group ids stored under key into rows"""
+        chat_ids = self.db.get(key)
+        if chat_ids is False:
+            return
+        for chat_id in chat_ids:
+            self.add(int(chat_id), "group", self.db.get(str(chat_id) + "_title") or None)
+        self.db.rem(key)
+
+    def add(self, chat_id, type, title) -> bool:
+        """Adds or updates a chat, returns True if it wasn't registered yet"""
+        key = self.prefix + str(chat_id)
+        now = time()
+        with self._lock:
+            old = self.db.get(key)
+            joined = old["joined"] if old else now
+            self.db.set(key, {"type": type, "title": title, "joined": joined, "seen": now})
+            if not old:
+                self._count(1)
+            if not old or old["title"] != title:
+                self.version += 1
+        return not old
+
+    def remove(self, chat_id) -> bool:
+        """Removes a chat, returns False if it wasn't registered"""
+        with self._lock:
+            if not self.db.exists(self.prefix + str(chat_id)):
+                return False
+            self.db.rem(self.prefix + str(chat_id))
+            self._count(-1)
+            self.version += 1
+        return True
+
+    def get(self, chat_id, cached=True):
+        """
+        The row of a chat, None if it isn't registered. cached=False reads
+        past the store's read cache, for rows other shards may have written.
+        """
+        return self.db.get(self.prefix + str(chat_id), cached) or None
+
+    def touch(self, chat_id, type=None, title=None) -> bool:
+        """
+        Records activity in a chat. With a type, a chat that isn't
+        registered is added, returns True if it was.
+        """
+        row = self.get(chat_id)
+        now = time()
+        if row is None:
+            return type is not None and self.add(chat_id, type, title)
+        if now - row["seen"] > TOUCH_INTERVAL:
+            self.db.set(self.prefix + str(chat_id), dict(row, seen=now))
+        return False
+
+    def __contains__(self, chat_id):
+        return self.db.exists(self.prefix + str(chat_id))
+
+    def _count(self, change):
+        count = (self.db.get(self._own_count_key) or 0) + change
+        if self.shard is None:
+            count = max(count, 0)
+        self.db.set(self._own_count_key, count)
+
+    def __len__(self):
+        count = self.db.get(self._own_count_key) or 0
+        if self.shard is None:
+            return count
+        now = monotonic()
+        if self._others_read is None or now - self._others_read > SHARD_COUNT_INTERVAL:
+            self._others = sum(
+                value for key, value in self.db.scan(self.count_key) if key != self._own_count_key
+            )
+            self._others_read = now
+        return max(count + self._others, 0)
+
+    def recount(self) -> bool:
+        """Counts the rows again, returns True if the stored count was wrong"""
+        with self._lock:
+            count = len(self.db.scan(self.prefix))
+            if self.db.get(self._own_count_key) == count:
+                return False
+            self.db.set(self._own_count_key, count)
+        return True
+
+    def page(self, cursor=None, limit=100):
+        """
+        Returns up to limit (chat id, row) pairs and the cursor of the next
+        page, which is None after the last page.
+        """
+        rows = self.db.scan(self.prefix, cursor, limit)
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return [(int(key[len(self.prefix):]), row) for key, row in rows], next_cursor
+
+    def __iter__(self):
+        """Iterates over all (chat id, row) pairs, one page at a time"""
+        cursor = None
+        while True:
+            rows, cursor = self.page(cursor)
+            yield from rows
+            if cursor is None:
+                return
+
+
+class PageCache:
+    """
+    Rendered pages of the registry, page_size chats each. Pages are kept
+    until the registry changes.
+    """
+
+    def __init__(self, registry, page_size=25):
+        self.registry = registry
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, version):
+        self._version = version
+        # Cursor each page starts after, as far as pages were read
+        self._cursors = [None]
+        self._pages = {}
+
+    def get(self, number, render):
+        """
+        Returns (page number, rendered page, whether there is a next page),
+        rendering the rows of a page with render(rows) on a miss. Pages are
+        counted from 0, numbers past the end give the last page.
+        """
+        with self._lock:
+            # Other shards don't change the version, but the number of chats
+            version = (self.registry.version, len(self.registry))
+            if self._version != version:
+                self._reset(version)
+            page = self._pages.get(number)
+            if page is not None:
+                return page
+
+            # Walk forward from the last page whose start is known
+            known = min(number, len(self._cursors) - 1)
+            cursor = self._cursors[known]
+            while True:
+                rows, next_cursor = self.registry.page(cursor, self.page_size)
+                if known == number or next_cursor is None:
+                    break
+                known += 1
+                cursor = next_cursor
+                if known == len(self._cursors):
+                    self._cursors.append(cursor)
+            # Only probe once whether the last full page has a successor
+            has_next = next_cursor is not None and bool(self.registry.page(next_cursor, 1)[0])
+            page = (known, render(rows), has_next)
+            self._pages[known] = page
+            return page
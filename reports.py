@@ -0,0 +1,37 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Collapses repeated /report commands about the same message into a single
+notification per time window.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class RecentReports:
+    """Remembers what was reported during the last window seconds"""
+
+    def __init__(self, window, maxsize=10000):
+        self.window = window
+        self.maxsize = maxsize
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.collapsed = 0
+
+    def first(self, key) -> bool:
+        """True if key wasn't reported during the window, and remembers it"""
+        now = monotonic()
+        with self._lock:
+            # Entries are in the order they were reported, drop expired ones
+            while self._seen:
+                oldest, when = next(iter(self._seen.items()))
+                if now - when < self.window and len(self._seen) < self.maxsize:
+                    break
+                del self._seen[oldest]
+            if key in self._seen:
+                self.collapsed += 1
+                return False
+            self._seen[key] = now
+            return True
@@ -0,0 +1,112 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Per-chat settings, loaded from the store once and kept in a bounded LRU.
+
+Every field maps to one key of the database schema described in welcome.py,
+missing keys keep the store's False value.
+"""
+
+import threading
+from collections import OrderedDict
+
+from templates import DEFAULT_BYE, DEFAULT_WELCOME, Template
+
+# ChatSettings attribute -> database key suffix
+FIELDS = {
+    "welcome": "",
+    "bye": "_bye",
+    "adm": "_adm",
+    "locked": "_lck",
+    "quiet": "_quiet",
+    "title": "_title",
+    "reports": "_reports",
+    "batch": "_batch",
+    "ttl": "_ttl",
+}
+
+
+class ChatSettings:
+    """The settings of a single chat"""
+
+    __slots__ = ("chat_id", "welcome_tpl", "bye_tpl") + tuple(FIELDS)
+
+    def __init__(self, chat_id, **fields):
+        self.chat_id = chat_id
+        self.welcome_tpl = None
+        self.bye_tpl = None
+        for name in FIELDS:
+            setattr(self, name, fields.get(name, False))
+
+    def welcome_template(self) -> Template:
+        """The compiled welcome message, the default one if none was set"""
+        if self.welcome_tpl is None:
+            self.welcome_tpl = Template(self.welcome) if self.welcome else DEFAULT_WELCOME
+        return self.welcome_tpl
+
+    def bye_template(self):
+        """The compiled goodbye message, None if goodbyes are disabled"""
+        if self.bye is None:
+            return None
+        if self.bye_tpl is None:
+            self.bye_tpl = Template(self.bye) if self.bye else DEFAULT_BYE
+        return self.bye_tpl
+
+
+class SettingsCache:
+    """
+    Bounded LRU of ChatSettings. Writes go to the store and the cached
+    record at the same time, so the cache never has to be reloaded.
+    """
+
+    def __init__(self, db, maxsize=10000):
+        self.db = db
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id) -> ChatSettings:
+        """Returns the settings of a chat, loading them on a miss"""
+        with self._lock:
+            settings = self._cache.get(chat_id)
+            if settings is not None:
+                self._cache.move_to_end(chat_id)
+                return settings
+
+        chat_str = str(chat_id)
+        settings = ChatSettings(
+            chat_id,
+            **{name: self.db.get(chat_str + suffix) for name, suffix in FIELDS.items()}
+        )
+
+        with self._lock:
+            # Another thread may have loaded the chat in the meantime
+            settings = self._cache.setdefault(chat_id, settings)
+            self._cache.move_to_end(chat_id)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return settings
+
+    def update(self, chat_id, **fields) -> ChatSettings:
+        """Changes one or more fields of a chat and writes them to the store"""
+        settings = self.get(chat_id)
+        chat_str = str(chat_id)
+        for name, value in fields.items():
+            setattr(settings, name, value)
+            self.db.set(chat_str + FIELDS[name], value)
+        # Recompile changed messages on their next use
+        if "welcome" in fields:
+            settings.welcome_tpl = None
+        if "bye" in fields:
+            settings.bye_tpl = None
+        return settings
+
+    def invalidate(self, chat_id):
+        """Drops a chat from the cache"""
+        with self._lock:
+            self._cache.pop(chat_id, None)
+
+    def clear(self):
+        """Drops every chat from the cache"""
+        with self._lock:
+            self._cache.clear()
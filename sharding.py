@@ -0,0 +1,216 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Splits the chats between several bot instances in webhook mode. All
+instances share one SQLite database (on a shared volume, with a rollback
+journal since WAL doesn't work across hosts) for their settings and
+register themselves in it with a heartbeat. Every chat belongs to the
+instance a consistent hash ring of the live instances picks, so when one
+joins or leaves only its share of the chats moves.
+
+Telegram (or a load balancer in front of the instances) may deliver an
+update to any instance. The instance forwards it to the owner of its chat,
+and every update is claimed in the database before it is processed, so no
+update is handled twice, not even while the instances disagree about the
+ring for a moment.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from lanes import lane_key
+
+logger = logging.getLogger(__name__)
+
+# Marks an update another instance forwarded, it is never forwarded again
+FORWARDED_HEADER = "X-Welcome-Forwarded-By"
+
+# Claimed update ids are kept this long, Telegram gives up on an update
+# long before
+CLAIM_TTL = 60 * 60
+
+
+def _hash(value) -> int:
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring, every node is placed at replicas points"""
+
+    def __init__(self, nodes=(), replicas=64):
+        points = sorted(
+            (_hash("%s#%d" % (node, i)), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def owner(self, key):
+        """The node key belongs to, None if the ring is empty"""
+        if not self._nodes:
+            return None
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[position]
+
+
+class ShardCoordinator:
+    """
+    Membership, routing and update claims of one instance. shard_id must be
+    unique and stable across restarts, url is where the other instances can
+    post updates to this one (its webhook URL on the internal network).
+    Updates whose owner can't be reached are put into update_queue.
+    on_rebalance is called after the ring changed, chats may have moved to
+    this instance then and cached state about them may be stale.
+    """
+
+    def __init__(
+        self,
+        path,
+        shard_id,
+        url,
+        update_queue,
+        secret=None,
+        heartbeat=5.0,
+        timeout=15.0,
+        on_rebalance=None,
+    ):
+        self.path = path
+        self.shard_id = shard_id
+        self.url = url
+        self.update_queue = update_queue
+        self.secret = secret or None
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.on_rebalance = on_rebalance
+        self.members = {}
+        self.ring = HashRing()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._conn = None
+
+        self.forwarded = 0
+        self.duplicates = 0
+        self.rebalances = 0
+
+    def start(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards (id TEXT PRIMARY KEY, url TEXT, seen REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS claims (update_id INTEGER PRIMARY KEY, shard TEXT, at REAL)"
+        )
+        self._executor = ThreadPoolExecutor(4, thread_name_prefix="forward")
+        self._beat()
+        self._thread = threading.Thread(target=self._run, name="shards", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Leaves the ring, so the others take over right away"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+        with self._lock:
+            self._conn.execute("DELETE FROM shards WHERE id = ?", (self.shard_id,))
+            self._conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                self._beat()
+            except Exception:
+                logger.exception("Shard heartbeat failed")
+
+    def _beat(self):
+        now = time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO shards (id, url, seen) VALUES (?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET url = excluded.url, seen = excluded.seen",
+                (self.shard_id, self.url, now),
+            )
+            rows = self._conn.execute(
+                "SELECT id, url FROM shards WHERE seen > ?", (now - self.timeout,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM claims WHERE at < ?", (now - CLAIM_TTL,))
+        members = dict(rows)
+        if members.keys() != self.members.keys():
+            logger.info("Shards changed to %s", ", ".join(sorted(members)))
+            self.ring = HashRing(members)
+            self.members = members
+            self.rebalances += 1
+            if self.on_rebalance is not None:
+                self.on_rebalance()
+        else:
+            self.members = members
+
+    def is_leader(self) -> bool:
+        """True on the live instance with the lowest id, which runs the chores of all"""
+        return min(self.members, default=self.shard_id) >= self.shard_id
+
+    def owner(self, chat_id):
+        """The id of the instance a chat belongs to"""
+        return self.ring.owner(chat_id) or self.shard_id
+
+    def claim(self, update_id) -> bool:
+        """Claims an update for this instance, False if another one has it"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO claims (update_id, shard, at) VALUES (?, ?, ?)",
+                (update_id, self.shard_id, time()),
+            )
+        return cursor.rowcount == 1
+
+    def accept(self, update, data, forwarded_by=None) -> bool:
+        """
+        Decides what happens to an update this instance received. Returns
+        True if it should process it, otherwise it was forwarded to its
+        owner or another instance already claimed it.
+        """
+        if forwarded_by is None:
+            owner = self.owner(lane_key(update))
+            url = self.members.get(owner)
+            if owner != self.shard_id and url:
+                self.forwarded += 1
+                self._executor.submit(self._forward, owner, url, update, data)
+                return False
+        return self._claim(update)
+
+    def _claim(self, update) -> bool:
+        if self.claim(update.update_id):
+            return True
+        self.duplicates += 1
+        return False
+
+    def _forward(self, owner, url, update, data):
+        headers = {"Content-Type": "application/json", FORWARDED_HEADER: self.shard_id}
+        if self.secret is not None:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret
+        request = urllib.request.Request(url, json.dumps(data).encode(), headers)
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                return
+        except OSError as e:
+            logger.warning("Forwarding update %s to %s failed: %s", update.update_id, owner, e)
+        # The owner may be gone, don't lose the update
+        if self._claim(update):
+            self.update_queue.put(update)
+
+    def stats(self) -> dict:
+        return {
+            "shards": len(self.members),
+            "forwarded": self.forwarded,
+            "duplicates": self.duplicates,
+            "rebalances": self.rebalances,
+        }
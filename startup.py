@@ -0,0 +1,51 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Timings of the startup phases. welcome.py imports this module first and
+marks the end of every phase, so the report shows where a restart spends its
+time: importing, opening the store, registering handlers, starting to poll
+and handling the first update.
+"""
+
+import logging
+import threading
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+STARTED = perf_counter()
+
+
+class StartupTimer:
+    def __init__(self, start=STARTED):
+        self.start = start
+        # Phase -> seconds, in the order the phases ended
+        self.phases = {}
+        self._last = start
+        self._lock = threading.Lock()
+
+    def done(self, phase):
+        """Ends a phase, it took the time since the previous one ended"""
+        with self._lock:
+            now = perf_counter()
+            self.phases[phase] = now - self._last
+            self._last = now
+
+    def since_start(self, phase) -> bool:
+        """
+        Records the time from the start until now, once per phase. Returns
+        False if the phase was recorded already.
+        """
+        with self._lock:
+            if phase in self.phases:
+                return False
+            self.phases[phase] = perf_counter() - self.start
+        return True
+
+    def report(self) -> str:
+        with self._lock:
+            phases = list(self.phases.items())
+        return ", ".join("%s %.3f s" % (phase, seconds) for phase, seconds in phases)
+
+
+TIMER = StartupTimer()
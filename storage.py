@@ -0,0 +1,715 @@
+#!/usr/bin/env python
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Key/value storage backends for the welcome bot.
+
+Both backends keep the pickledb calling convention used throughout welcome.py
+(get() returns False for a missing key) so the key schema does not change.
+Writes only touch memory and are flushed in batches by a background thread,
+on a timer and at shutdown.
+
+JournalStore  - the pickledb compatible JSON snapshot (bot.db) plus an
+                append-only journal (bot.db.journal). Each write costs
+                O(1), the journal is folded back into the snapshot in the
+                background once it grows too large. With lazy=True the
+                file is read in a background thread and the first access
+                waits for it.
+SQLiteStore   - a single table in a SQLite database running in WAL mode.
+                Nothing is loaded up front and reads go through a memory
+                map of the file, so opening it costs the same at any size.
+                With shared=True it uses a rollback journal and no memory
+                map instead, for a database on a network filesystem.
+
+Usage:
+    python storage.py migrate bot.db sqlite:bot.sqlite3
+"""
+
+import atexit
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Marks a pending deletion in the write buffer
+_DELETED = object()
+# Marks a key known to be absent in the read cache
+_MISSING = object()
+
+
+class Store:
+    """
+    Base class for the storage backends. Subclasses implement _load(),
+    _read(), _write_batch(), iter_items() and optionally compact() and
+    rewrite().
+    """
+
+    def __init__(self, location, flush_interval=1.0):
+        self.location = os.path.expanduser(location)
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._closed = False
+        self._stop = threading.Event()
+        self._thread = None
+        # Counters for stats()
+        self.reads = 0
+        self.writes = 0
+        self.flushes = 0
+        self.flushed_keys = 0
+        self.flushed_bytes = 0
+        self.flush_seconds = 0.0
+        self.compactions = 0
+        self.compact_seconds = 0.0
+        self.load_seconds = 0.0
+        self._load()
+
+    def start(self):
+        """Starts the background flush thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="store-flush", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self._should_compact():
+                    self.compact()
+            except Exception:
+                logger.exception("Flushing %s failed", self.location)
+
+    def get(self, key, cached=True):
+        """
+        Get the value of a key, False if it does not exist. cached=False
+        reads past the read cache, for keys other processes write to.
+        """
+        with self._lock:
+            self.reads += 1
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._read(key) if cached else self._read_uncached(key)
+        if value is _MISSING or value is _DELETED:
+            return False
+        return value
+
+    def set(self, key, value):
+        """Set the value of a key"""
+        if not isinstance(key, str):
+            raise TypeError("Key/name must be a string!")
+        with self._lock:
+            self.writes += 1
+            self._pending[key] = value
+            self._set_cached(key, value)
+        return True
+
+    def rem(self, key):
+        """Delete a key"""
+        with self._lock:
+            self.writes += 1
+            self._pending[key] = _DELETED
+            self._set_cached(key, _MISSING)
+        return True
+
+    def exists(self, key):
+        """Return True if key exists"""
+        with self._lock:
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._read(key)
+        return value is not _MISSING and value is not _DELETED
+
+    def flush(self):
+        """Write all buffered changes to disk"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+            start = perf_counter()
+            try:
+                written = self._write_batch(batch)
+            except Exception:
+                self._restore(batch)
+                raise
+            self.flush_seconds += perf_counter() - start
+            self.flushes += 1
+            self.flushed_keys += len(batch)
+            self.flushed_bytes += written
+            return len(batch)
+
+    # pickledb name for flush()
+    dump = flush
+
+    def _restore(self, batch):
+        """Puts a batch that couldn't be written back, behind the newer writes"""
+        with self._lock:
+            for key, value in batch.items():
+                self._pending.setdefault(key, value)
+
+    def compact(self):
+        """Reclaim the space taken by overwritten and deleted keys"""
+
+    def rewrite(self):
+        """Rewrites the whole store into a fresh, compact file"""
+        self.compact()
+
+    def iter_items(self, page_size=1000):
+        """Yields every (key, value) pair, without holding the lock for long"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Counters and the size of the files on disk"""
+        return dict(
+            reads=self.reads,
+            writes=self.writes,
+            pending=len(self._pending),
+            flushes=self.flushes,
+            flushed_keys=self.flushed_keys,
+            flushed_bytes=self.flushed_bytes,
+            flush_seconds=self.flush_seconds,
+            compactions=self.compactions,
+            compact_seconds=self.compact_seconds,
+            load_seconds=self.load_seconds,
+            **self._sizes()
+        )
+
+    def _sizes(self):
+        return {}
+
+    def close(self):
+        """Stops the flush thread and writes everything to disk"""
+        if self._closed:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self._close()
+        self._closed = True
+
+    def import_json(self, path):
+        """Copies every key of a pickledb JSON file into this store"""
+        data = read_json_db(path)
+        for key, value in data.items():
+            self.set(key, value)
+        self.flush()
+        return len(data)
+
+    def _should_compact(self):
+        return False
+
+    def _read_uncached(self, key):
+        return self._read(key)
+
+    def _set_cached(self, key, value):
+        pass
+
+    def _close(self):
+        pass
+
+
+class JournalStore(Store):
+    """
+    Keeps every key in memory. The snapshot is a plain JSON object, exactly
+    what pickledb writes, so an existing bot.db is read as-is.
+    """
+
+    def __init__(
+        self,
+        location,
+        flush_interval=1.0,
+        fsync=True,
+        compact_min_bytes=1 << 20,
+        compact_ratio=1.0,
+        lazy=False,
+    ):
+        self.journal_path = os.path.expanduser(location) + ".journal"
+        self.lazy = lazy
+        self.fsync = fsync
+        self.compact_min_bytes = compact_min_bytes
+        self.compact_ratio = compact_ratio
+        self._compact_lock = threading.Lock()
+        # prefix -> sorted list of the keys starting with it, built by scan()
+        self._indexes = {}
+        super().__init__(location, flush_interval)
+
+    def _load(self):
+        self._data = {}
+        self._snapshot_bytes = 0
+        self._loaded = threading.Event()
+        self._load_error = None
+        # Nothing is appended before the journal was replayed, every write
+        # waits for the data first
+        self._journal = open(self.journal_path, "ab")
+        self._journal_bytes = self._journal.tell()
+        if self.lazy:
+            threading.Thread(target=self._read_files, name="store-load", daemon=True).start()
+        else:
+            self._read_files()
+            self._wait()
+
+    def _read_files(self):
+        start = perf_counter()
+        try:
+            self._data = read_json_db(self.location, repair=True)
+            self._snapshot_bytes = (
+                os.path.getsize(self.location) if os.path.exists(self.location) else 0
+            )
+            # Appends go to the end of the repaired journal
+            self._journal_bytes = os.path.getsize(self.journal_path)
+        except Exception as e:
+            self._load_error = e
+        self.load_seconds = perf_counter() - start
+        self._loaded.set()
+
+    def _wait(self):
+        """Blocks until the files were read"""
+        if not self._loaded.is_set():
+            self._loaded.wait()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def _read(self, key):
+        self._wait()
+        return self._data.get(key, _MISSING)
+
+    def _set_cached(self, key, value):
+        self._wait()
+        if value is _MISSING:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self._unindex(key)
+        else:
+            if key not in self._data:
+                self._index(key)
+            self._data[key] = value
+
+    def _index(self, key):
+        for prefix, index in self._indexes.items():
+            if key.startswith(prefix):
+                bisect.insort(index, key)
+
+    def _unindex(self, key):
+        for prefix, index in self._indexes.items():
+            if key.startswith(prefix):
+                del index[bisect.bisect_left(index, key)]
+
+    def scan(self, prefix, start_after=None, limit=None):
+        """
+        Returns up to limit (key, value) pairs whose key starts with prefix,
+        sorted by key and starting after the key start_after.
+        """
+        with self._lock:
+            self._wait()
+            index = self._indexes.get(prefix)
+            if index is None:
+                index = sorted(key for key in self._data if key.startswith(prefix))
+                self._indexes[prefix] = index
+            start = bisect.bisect_right(index, start_after) if start_after else 0
+            end = len(index) if limit is None else start + limit
+            return [(key, self._data[key]) for key in index[start:end]]
+
+    def _write_batch(self, batch):
+        lines = []
+        for key, value in batch.items():
+            line = _encode([key] if value is _DELETED else [key, value])
+            if line is None:
+                # It would break every snapshot too
+                with self._lock:
+                    if self._data.get(key) is value:
+                        self._data.pop(key)
+                        self._unindex(key)
+                continue
+            lines.append(line)
+        if not lines:
+            return 0
+        payload = ("\n".join(lines) + "\n").encode()
+        with self._lock:
+            try:
+                self._journal.write(payload)
+                self._journal.flush()
+                if self.fsync:
+                    os.fsync(self._journal.fileno())
+            except OSError:
+                # Don't leave a torn entry the retry would be appended to
+                self._reopen_journal()
+                raise
+            self._journal_bytes += len(payload)
+        return len(payload)
+
+    def _reopen_journal(self):
+        try:
+            self._journal.close()
+        except OSError:
+            pass
+        os.truncate(self.journal_path, self._journal_bytes)
+        self._journal = open(self.journal_path, "ab")
+
+    def _should_compact(self):
+        return self._loaded.is_set() and self._journal_bytes > max(
+            self.compact_min_bytes, self._snapshot_bytes * self.compact_ratio
+        )
+
+    def compact(self):
+        """Folds the journal into a fresh snapshot"""
+        self._wait()
+        start = perf_counter()
+        with self._compact_lock:
+            with self._flush_lock:
+                with self._lock:
+                    batch, self._pending = self._pending, {}
+                if batch:
+                    try:
+                        self._write_batch(batch)
+                    except Exception:
+                        self._restore(batch)
+                        raise
+                with self._lock:
+                    data = dict(self._data)
+                    self._journal.close()
+                    os.replace(self.journal_path, self.journal_path + ".old")
+                    self._journal = open(self.journal_path, "ab")
+                    self._journal_bytes = 0
+
+            # Writes keep going to the new journal while the snapshot is written
+            temp = self.location + ".tmp"
+            with open(temp, "wt") as f:
+                json.dump(data, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.location)
+            os.remove(self.journal_path + ".old")
+            self._snapshot_bytes = os.path.getsize(self.location)
+            self.compactions += 1
+            self.compact_seconds += perf_counter() - start
+        logger.info("Compacted %s to %d bytes", self.location, self._snapshot_bytes)
+
+    def _sizes(self):
+        return {"snapshot_bytes": self._snapshot_bytes, "journal_bytes": self._journal_bytes}
+
+    def keys(self):
+        self._wait()
+        with self._lock:
+            return list(self._data)
+
+    def iter_items(self, page_size=1000):
+        self._wait()
+        with self._lock:
+            items = list(self._data.items())
+        for key, value in items:
+            yield key, value
+
+    def __len__(self):
+        self._wait()
+        return len(self._data)
+
+    def _close(self):
+        self._journal.close()
+
+
+class SQLiteStore(Store):
+    """
+    Stores one row per key in a SQLite database in WAL mode. Values are read
+    on demand and cached, so opening a large database costs nothing.
+    WAL and mmap need memory shared by every process using the database, so
+    they only work on one host. shared=True is for a database that
+    processes on several hosts open over a network filesystem.
+    """
+
+    def __init__(
+        self,
+        location,
+        flush_interval=1.0,
+        checkpoint_pages=1000,
+        mmap_size=256 << 20,
+        shared=False,
+    ):
+        self.checkpoint_pages = checkpoint_pages
+        self.shared = shared
+        # Bytes of the database file read through mmap instead of read()
+        self.mmap_size = 0 if shared else mmap_size
+        super().__init__(location, flush_interval)
+
+    def _load(self):
+        start = perf_counter()
+        self._cache = {}
+        self._wal_pages = 0
+        # Reads that missed the cache
+        self.disk_reads = 0
+        self.disk_read_seconds = 0.0
+        self._conn = sqlite3.connect(
+            self.location, check_same_thread=False, isolation_level=None
+        )
+        # Other processes may hold the lock for a moment
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        if self.shared:
+            # Also turns WAL off for a database that was used in WAL mode
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.execute("PRAGMA synchronous=FULL")
+        else:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            " WITHOUT ROWID"
+        )
+        self.load_seconds = perf_counter() - start
+
+    def _read(self, key):
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return self._read_uncached(key)
+
+    def _read_uncached(self, key):
+        start = perf_counter()
+        row = self._conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        value = json.loads(row[0]) if row else _MISSING
+        self.disk_reads += 1
+        self.disk_read_seconds += perf_counter() - start
+        self._cache[key] = value
+        return value
+
+    def _set_cached(self, key, value):
+        self._cache[key] = value
+
+    def _write_batch(self, batch):
+        upserts = []
+        deletes = []
+        for key, value in batch.items():
+            if value is _DELETED:
+                deletes.append((key,))
+                continue
+            encoded = _encode(value)
+            if encoded is not None:
+                upserts.append((key, encoded))
+        written = sum(len(key) + len(value) for key, value in upserts)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO kv (key, value) VALUES (?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    upserts,
+                )
+                self._conn.executemany("DELETE FROM kv WHERE key = ?", deletes)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._wal_pages += len(batch)
+        return written
+
+    def _should_compact(self):
+        return self._wal_pages > self.checkpoint_pages
+
+    def invalidate(self):
+        """Forgets the cached values, for when other processes write to the database"""
+        with self._lock:
+            self._cache.clear()
+
+    def compact(self):
+        """Checkpoints the WAL back into the main database file"""
+        self.flush()
+        start = perf_counter()
+        with self._lock:
+            if not self.shared:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._wal_pages = 0
+            self.compactions += 1
+            self.compact_seconds += perf_counter() - start
+
+    def rewrite(self):
+        """
+        Copies the database into a new file without free pages (VACUUM).
+        It runs on its own connection, so reads keep being served from the
+        store meanwhile. Flushes wait for it, up to the busy timeout, and
+        are retried later.
+        """
+        self.flush()
+        start = perf_counter()
+        conn = sqlite3.connect(self.location, isolation_level=None)
+        try:
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("VACUUM")
+            if not self.shared:
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        self._wal_pages = 0
+        self.compactions += 1
+        self.compact_seconds += perf_counter() - start
+        logger.info("Rewrote %s", self.location)
+
+    def _sizes(self):
+        sizes = {"disk_reads": self.disk_reads, "disk_read_seconds": self.disk_read_seconds}
+        for name, path in (
+            ("database_bytes", self.location),
+            ("wal_bytes", self.location + "-wal"),
+        ):
+            sizes[name] = os.path.getsize(path) if os.path.exists(path) else 0
+        return sizes
+
+    def keys(self):
+        self.flush()
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT key FROM kv")]
+
+    def iter_items(self, page_size=1000):
+        self.flush()
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT key, value FROM kv WHERE key > ? ORDER BY key LIMIT ?",
+                    (last, page_size),
+                ).fetchall()
+            for key, value in rows:
+                yield key, json.loads(value)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def scan(self, prefix, start_after=None, limit=None):
+        """
+        Returns up to limit (key, value) pairs whose key starts with prefix,
+        sorted by key and starting after the key start_after.
+        """
+        if start_after is not None and start_after >= prefix:
+            condition, lower = "key > ?", start_after
+        else:
+            condition, lower = "key >= ?", prefix
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM kv WHERE %s AND key < ? ORDER BY key LIMIT ?"
+                % condition,
+                (lower, prefix + "\U0010ffff", -1 if limit is None else limit),
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows if key.startswith(prefix)]
+
+    def __len__(self):
+        self.flush()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+
+    def _close(self):
+        self.compact()
+        self._conn.close()
+
+
+def _encode(value):
+    """value as compact JSON, None (and an error logged) if it can't be encoded"""
+    try:
+        return json.dumps(value, separators=(",", ":"))
+    except (TypeError, ValueError) as e:
+        logger.error("Can't store %.100r: %s", value, e)
+        return None
+
+
+def _replay(data, path):
+    """
+    Applies a journal to data. Returns the number of entries applied and the
+    offset after the last intact one.
+    """
+    if not os.path.exists(path):
+        return 0, 0
+    count = offset = end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            offset += len(line)
+            try:
+                # Without the newline the write was torn, even if it parses
+                entry = json.loads(line) if line.endswith(b"\n") else None
+            except ValueError:
+                entry = None
+            if not isinstance(entry, list) or not 1 <= len(entry) <= 2:
+                # A torn write at the end, or in the middle of a journal an
+                # older version kept appending to after a crash. The entries
+                # after it are intact.
+                logger.warning("Ignoring damaged journal entry in %s", path)
+                continue
+            if len(entry) == 2:
+                data[entry[0]] = entry[1]
+            else:
+                data.pop(entry[0], None)
+            count += 1
+            end = offset
+    return count, end
+
+
+def read_json_db(path, repair=False):
+    """
+    Reads a pickledb JSON file and replays its journal on top of it. With
+    repair a torn entry at the end of the journal is cut off, so the next
+    write doesn't end up on the same line.
+    """
+    path = os.path.expanduser(path)
+    data = {}
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rt") as f:
+            data = json.load(f)
+    # A compaction that was interrupted leaves the previous journal behind,
+    # nothing is appended to that one anymore
+    replayed = _replay(data, path + ".journal.old")[0]
+    count, end = _replay(data, path + ".journal")
+    replayed += count
+    if repair and os.path.exists(path + ".journal") and os.path.getsize(path + ".journal") > end:
+        logger.warning("Truncating %s.journal to its last intact entry", path)
+        os.truncate(path + ".journal", end)
+    if replayed:
+        logger.info("Replayed %d journal entries from %s.journal", replayed, path)
+    return data
+
+
+def open_store(url, migrate_from=None, **kwargs):
+    """
+    Opens and starts the backend described by url. A plain path opens a
+    JournalStore, "sqlite:<path>" a SQLiteStore. If migrate_from names an
+    existing pickledb file and the new store is empty, its keys are imported.
+    lazy is ignored by SQLite, which only reads what it is asked for anyway,
+    shared by the JSON store, which only one process can use.
+    """
+    if url.startswith("sqlite:"):
+        kwargs.pop("lazy", None)
+        store = SQLiteStore(url[len("sqlite:"):], **kwargs)
+    else:
+        kwargs.pop("shared", None)
+        store = JournalStore(url, **kwargs)
+
+    if (
+        migrate_from
+        and os.path.abspath(os.path.expanduser(migrate_from)) != os.path.abspath(store.location)
+        and os.path.exists(migrate_from)
+        and len(store) == 0
+    ):
+        count = store.import_json(migrate_from)
+        logger.info("Migrated %d keys from %s to %s", count, migrate_from, url)
+
+    atexit.register(store.close)
+    return store.start()
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] != "migrate":
+        print(__doc__.strip().splitlines()[-1].strip())
+        return 2
+    logging.basicConfig(level=logging.INFO)
+    store = open_store(argv[3], migrate_from=argv[2])
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
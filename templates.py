@@ -0,0 +1,54 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Welcome and goodbye messages, compiled once into a list of segments.
+
+Supported placeholders: $username, $title and $n (a line break).
+"""
+
+import re
+from html import escape
+
+_PLACEHOLDER = re.compile(r"\$username|\$title|\$n")
+
+# Placeholder -> index into the values passed to render()
+_SLOTS = {"$username": 0, "$title": 1}
+
+
+class Template:
+    """
+    A message split into literal text and placeholder slots. Literals sit at
+    the even positions of segments, slot indices at the odd ones.
+    """
+
+    __slots__ = ("segments", "slots")
+
+    def __init__(self, text):
+        segments = []
+        literal = []
+        pos = 0
+        for match in _PLACEHOLDER.finditer(text):
+            literal.append(text[pos:match.start()])
+            pos = match.end()
+            token = match.group()
+            if token == "$n":
+                literal.append("\n")
+            else:
+                segments.append("".join(literal))
+                segments.append(_SLOTS[token])
+                literal = []
+        literal.append(text[pos:])
+        segments.append("".join(literal))
+        self.segments = segments
+        self.slots = segments[1::2]
+
+    def render(self, username, title):
+        """Fills in the placeholders, both values are HTML escaped"""
+        values = (escape(username, False), escape(title or "", False))
+        parts = self.segments[:]
+        parts[1::2] = [values[slot] for slot in self.slots]
+        return "".join(parts)
+
+
+DEFAULT_WELCOME = Template("Hello $username! Welcome to $title")
+DEFAULT_BYE = Template("Goodbye, $username!")
@@ -0,0 +1 @@
+# This program is dedicated to the public domain under the CC0 license.
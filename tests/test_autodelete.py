@@ -0,0 +1,43 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""Persistence of the deletion queue"""
+
+from time import time
+
+import storage
+from autodelete import DeletionQueue
+
+
+def test_only_changed_buckets_are_written(tmp_path):
+    db = storage.JournalStore(str(tmp_path / "bot.db"), flush_interval=3600)
+    queue = DeletionQueue(db)
+    queue.add(-1, 1, 0)
+    queue.add(-1, 2, 3600)
+    queue.save()
+    db.flush()
+    writes = db.writes
+
+    queue.add(-2, 3, 0)
+    assert queue.pop_due() == {-1: [1], -2: [3]}
+    queue.save()
+    # The bucket due now was emptied and removed, the later one untouched
+    assert db.writes == writes + 1
+    assert len(db.scan("autodelete:")) == 1
+    db.close()
+
+
+def test_queue_survives_a_restart(tmp_path):
+    path = str(tmp_path / "bot.db")
+    db = storage.JournalStore(path, flush_interval=3600)
+    # Saved by an older version as one list
+    db.set("autodelete", [[time() - 1, -1, 1]])
+    queue = DeletionQueue(db)
+    queue.add(-1, 2, 0)
+    queue.save()
+    db.close()
+
+    db = storage.JournalStore(path, flush_interval=3600)
+    queue = DeletionQueue(db)
+    assert db.get("autodelete") is False
+    assert queue.pop_due() == {-1: [1, 2]}
+    db.close()
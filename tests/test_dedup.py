@@ -0,0 +1,104 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""Which updates the UpdateFilter drops"""
+
+from datetime import datetime, timezone
+
+from telegram import Chat, ChatMember, ChatMemberUpdated, Update, User
+
+import storage
+from dedup import DUPLICATE, FLAP, REPLAY, UpdateFilter
+
+BOT = User(1, "Bot", True)
+ADMIN = User(2, "Admin", False)
+MEMBER = User(3, "Member", False)
+GROUP = Chat(-100, Chat.SUPERGROUP)
+START = 1_700_000_000
+
+
+def status_change(change):
+    was_member = change.old_chat_member.status == ChatMember.MEMBER
+    is_member = change.new_chat_member.status == ChatMember.MEMBER
+    return was_member, is_member
+
+
+def member_update(update_id, seconds, joined, user=MEMBER, mine=False):
+    statuses = (ChatMember.LEFT, ChatMember.MEMBER)
+    if not joined:
+        statuses = statuses[::-1]
+    change = ChatMemberUpdated(
+        GROUP,
+        ADMIN,
+        datetime.fromtimestamp(START + seconds, timezone.utc),
+        ChatMember(user, statuses[0]),
+        ChatMember(user, statuses[1]),
+    )
+    if mine:
+        return Update(update_id, my_chat_member=change)
+    return Update(update_id, chat_member=change)
+
+
+def make_filter(db=None, flap_window=10):
+    return UpdateFilter(status_change, db, flap_window=flap_window)
+
+
+def test_duplicate_after_restart(tmp_path):
+    db = storage.JournalStore(str(tmp_path / "bot.db"), flush_interval=3600)
+    update_filter = make_filter(db)
+    assert update_filter.accept(Update(1))
+    assert not update_filter.accept(Update(1))
+    update_filter.save()
+    db.close()
+
+    db = storage.JournalStore(str(tmp_path / "bot.db"), flush_interval=3600)
+    update_filter = make_filter(db)
+    update_filter.load()
+    assert not update_filter.accept(Update(1))
+    assert update_filter.accept(Update(2))
+    assert update_filter.dropped[DUPLICATE] == 1
+    db.close()
+
+
+def test_oldest_ids_are_forgotten():
+    update_filter = UpdateFilter(status_change, size=2)
+    for update_id in (1, 2, 3):
+        assert update_filter.accept(Update(update_id))
+    assert update_filter.accept(Update(1))
+    assert not update_filter.accept(Update(3))
+
+
+def test_rejoin_within_flap_window_is_dropped():
+    update_filter = make_filter()
+    assert update_filter.accept(member_update(1, 0, True))
+    assert update_filter.accept(member_update(2, 3, False))
+    assert not update_filter.accept(member_update(3, 6, True))
+    assert update_filter.dropped[FLAP] == 1
+
+
+def test_rejoin_after_flap_window_is_greeted():
+    update_filter = make_filter()
+    assert update_filter.accept(member_update(1, 0, True))
+    assert update_filter.accept(member_update(2, 5, False))
+    assert update_filter.accept(member_update(3, 11, True))
+    # Another member isn't affected by the first one's joins
+    assert update_filter.accept(member_update(4, 12, True, User(4, "Other", False)))
+
+
+def test_flap_window_zero_only_drops_replays():
+    update_filter = make_filter(flap_window=0)
+    assert update_filter.accept(member_update(1, 0, True))
+    assert update_filter.accept(member_update(2, 1, False))
+    assert update_filter.accept(member_update(3, 2, True))
+    # The same join under a new update id
+    assert not update_filter.accept(member_update(4, 2, True))
+    assert update_filter.dropped[REPLAY] == 1
+
+
+def test_bot_membership_is_only_checked_for_replays():
+    update_filter = make_filter()
+    assert update_filter.accept(member_update(1, 0, True, BOT, mine=True))
+    assert update_filter.accept(member_update(2, 1, False, BOT, mine=True))
+    # A member would be a flap, the bot must be registered again
+    assert update_filter.accept(member_update(3, 2, True, BOT, mine=True))
+    assert not update_filter.accept(member_update(4, 1, True, BOT, mine=True))
+    assert update_filter.dropped == {DUPLICATE: 0, REPLAY: 1, FLAP: 0}
@@ -0,0 +1,66 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""Rate limits of the send scheduler"""
+
+import threading
+from time import monotonic
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbox import SendScheduler, TokenBucket
+
+
+def test_bucket_allows_bursts_then_the_rate():
+    bucket = TokenBucket(rate=2, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_pause_hands_out_no_tokens():
+    bucket = TokenBucket(rate=10, capacity=10)
+    now = bucket.updated
+    bucket.pause(5, now)
+    assert bucket.delay(now + 1) == pytest.approx(4)
+    # Empty after the pause, the tokens come back at the rate
+    assert bucket.delay(now + 5) == pytest.approx(0.1)
+    assert bucket.delay(now + 5.1) == 0
+    # A shorter pause doesn't cut a longer one short
+    bucket.pause(1, now + 6)
+    bucket.pause(0.5, now + 6)
+    assert bucket.delay(now + 6.5) == pytest.approx(0.5)
+
+
+class FloodedBot:
+    """Answers the first message with RetryAfter"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self.calls = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls.append((monotonic(), chat_id))
+        if len(self.calls) == 1:
+            raise RetryAfter(self.retry_after)
+        return text
+
+
+def test_retry_after_pauses_the_chat_and_retries():
+    bot = FloodedBot(0.3)
+    sender = SendScheduler(global_rate=1000, group_rate=1000, group_burst=10)
+    sent = threading.Event()
+    sender.start(bot)
+    try:
+        start = monotonic()
+        sender.send(-1, "hi", on_sent=lambda message: sent.set())
+        assert sent.wait(5)
+    finally:
+        sender.stop()
+    assert [chat_id for _, chat_id in bot.calls] == [-1, -1]
+    assert bot.calls[1][0] - start >= 0.3
+    stats = sender.stats()
+    assert (stats["rate_limited"], stats["retried"], stats["sent"]) == (1, 1, 1)
@@ -0,0 +1,40 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""Raid detection"""
+
+from raids import NORMAL, ONGOING, STARTED, RaidDetector
+
+
+def test_raid_starts_at_threshold_within_window():
+    detector = RaidDetector(threshold=3, window=10, cooldown=60)
+    assert [detector.join(-1, now) for now in (0, 1, 2)] == [NORMAL, NORMAL, NORMAL]
+    assert detector.join(-1, 3) == STARTED
+    assert detector.join(-1, 4) == ONGOING
+    assert detector.raided(-1, 5)
+    assert not detector.raided(-2, 5)
+    assert detector.raids == 1
+
+
+def test_slow_joins_are_no_raid():
+    detector = RaidDetector(threshold=3, window=10, cooldown=60)
+    assert {detector.join(-1, now) for now in range(0, 100, 5)} == {NORMAL}
+
+
+def test_raid_ends_after_cooldown():
+    detector = RaidDetector(threshold=2, window=10, cooldown=60)
+    for now in (0, 1, 2):
+        detector.join(-1, now)
+    # Single joins during the cooldown keep the raid going without extending it
+    assert detector.join(-1, 40) == ONGOING
+    assert detector.raided(-1, 61)
+    assert not detector.raided(-1, 62.5)
+    assert detector.join(-1, 100) == NORMAL
+    # A new spike starts a new raid
+    assert detector.join(-1, 101) == NORMAL
+    assert detector.join(-1, 102) == STARTED
+    assert detector.raids == 2
+
+
+def test_threshold_zero_never_detects():
+    detector = RaidDetector(threshold=0)
+    assert {detector.join(-1, now / 100) for now in range(100)} == {NORMAL}
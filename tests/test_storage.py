@@ -0,0 +1,134 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""Crash recovery of the JournalStore journal"""
+
+import json
+
+import storage
+
+
+def open_journal(path):
+    # No flush thread, the tests flush themselves
+    return storage.JournalStore(str(path), flush_interval=3600)
+
+
+def test_torn_entry_is_cut_off(tmp_path):
+    path = tmp_path / "bot.db"
+    store = open_journal(path)
+    store.set("a", 1)
+    store.set("b", 2)
+    store.close()
+    # The process died while appending the next batch
+    with open(str(path) + ".journal", "ab") as f:
+        f.write(b'["c",')
+
+    store = open_journal(path)
+    assert store.get("c") is False
+    store.set("d", 4)
+    store.set("a", 10)
+    store.close()
+
+    store = open_journal(path)
+    assert (store.get("a"), store.get("b"), store.get("d")) == (10, 2, 4)
+    store.close()
+
+
+def test_entries_after_damaged_line_are_replayed(tmp_path):
+    # What older versions left behind: writes appended onto a torn entry
+    path = tmp_path / "bot.db"
+    entries = [["a", 1], ["b", 2]]
+    with open(str(path) + ".journal", "wb") as f:
+        f.write(b"".join(json.dumps(e).encode() + b"\n" for e in entries))
+        f.write(b'["c",["d",4]\n["a",10]\n["b"]\n')
+
+    store = open_journal(path)
+    assert (store.get("a"), store.get("b"), store.get("d")) == (10, False, False)
+    store.close()
+
+
+def test_lazy_load_repairs_journal(tmp_path):
+    path = tmp_path / "bot.db"
+    with open(str(path) + ".journal", "wb") as f:
+        f.write(b'["a",1]\n["b",')
+
+    store = storage.JournalStore(str(path), flush_interval=3600, lazy=True)
+    store.set("c", 3)
+    store.close()
+
+    store = open_journal(path)
+    assert (store.get("a"), store.get("b"), store.get("c")) == (1, False, 3)
+    store.close()
+
+
+def fail_once(store):
+    write_batch = store._write_batch
+
+    def failing(batch):
+        store._write_batch = write_batch
+        raise OSError("disk full")
+
+    store._write_batch = failing
+
+
+def test_failed_flush_keeps_the_batch(tmp_path):
+    for url in (str(tmp_path / "bot.db"), "sqlite:" + str(tmp_path / "bot.sqlite3")):
+        store = storage.open_store(url, flush_interval=3600)
+        store.set("a", 1)
+        store.set("b", 2)
+        fail_once(store)
+        try:
+            store.flush()
+        except OSError:
+            pass
+        # Newer writes win over the batch that is put back
+        store.set("b", 3)
+        assert store.stats()["flushes"] == 0
+        store.close()
+
+        store = storage.open_store(url, flush_interval=3600)
+        assert (store.get("a"), store.get("b")) == (1, 3)
+        store.close()
+
+
+def test_value_that_cant_be_encoded_is_dropped_alone(tmp_path):
+    for url in (str(tmp_path / "bot.db"), "sqlite:" + str(tmp_path / "bot.sqlite3")):
+        store = storage.open_store(url, flush_interval=3600)
+        store.set("a", 1)
+        store.set("bad", object())
+        store.flush()
+        store.compact()
+        store.close()
+
+        store = storage.open_store(url, flush_interval=3600)
+        assert (store.get("a"), store.get("bad")) == (1, False)
+        store.close()
+
+
+def test_torn_write_is_not_appended_to(tmp_path):
+    path = tmp_path / "bot.db"
+    store = open_journal(path)
+    store.set("a", 1)
+    store.flush()
+    journal = store._journal
+
+    class Torn:
+        def write(self, payload):
+            journal.write(payload[:3])
+            journal.flush()
+            raise OSError("disk full")
+
+        def __getattr__(self, name):
+            return getattr(journal, name)
+
+    store._journal = Torn()
+    store.set("b", 2)
+    try:
+        store.flush()
+    except OSError:
+        pass
+    store.set("c", 3)
+    store.close()
+
+    store = open_journal(path)
+    assert (store.get("a"), store.get("b"), store.get("c")) == (1, 2, 3)
+    store.close()
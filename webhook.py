@@ -0,0 +1,178 @@
+# This program is dedicated to the public domain under the CC0 license.
+
+"""
+Small HTTP server receiving updates from Telegram's webhook, meant to run
+behind a reverse proxy that terminates TLS.
+
+POST <path>     an update, checked against the secret token
+GET  /healthz   200 while the server is running
+GET  /readyz    200 once the webhook is set and the dispatcher is running
+GET  /metrics   the bot's metrics, if a registry was given
+"""
+
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from metrics import CONTENT_TYPE
+from sharding import FORWARDED_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Telegram's updates are far smaller than this
+MAX_BODY = 1 << 20
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "WelcomeBot"
+
+    def _respond(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        webhook = self.server.webhook
+        if self.path == "/healthz":
+            self._respond(200, b"ok")
+        elif self.path == "/readyz":
+            if webhook.is_ready():
+                self._respond(200, b"ready")
+            else:
+                self._respond(503, b"not ready")
+        elif self.path == "/metrics" and webhook.metrics is not None:
+            body = webhook.metrics.render().encode()
+            self._respond(200, body, [("Content-Type", CONTENT_TYPE)])
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self._respond(404)
+            return
+
+        if webhook.secret is not None:
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), webhook.secret.encode()):
+                webhook.rejected += 1
+                self._respond(403)
+                return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            webhook.malformed += 1
+            self._respond(400)
+            return
+        if length > MAX_BODY:
+            self._respond(413)
+            return
+        try:
+            data = json.loads(self.rfile.read(length))
+            # Telegram retries updates that weren't answered with 200
+            queued = webhook.submit(data, self.headers.get(FORWARDED_HEADER))
+        except ValueError as e:
+            webhook.malformed += 1
+            logger.debug("Malformed update from %s: %s", self.address_string(), e)
+            self._respond(400)
+            return
+        if not queued:
+            self._respond(503, headers=[("Retry-After", "1")])
+            return
+        self._respond(200)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer:
+    """
+    Puts the updates it receives into the dispatcher's update queue, but
+    answers 503 instead while more than max_queue updates are waiting or
+    the dispatcher isn't running.
+    """
+
+    def __init__(
+        self,
+        dispatcher,
+        listen="127.0.0.1",
+        port=8080,
+        path="/telegram",
+        secret=None,
+        max_queue=1000,
+        metrics=None,
+        shards=None,
+    ):
+        self.dispatcher = dispatcher
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret or None
+        self.max_queue = max_queue
+        self.metrics = metrics
+        # ShardCoordinator deciding which updates are processed here
+        self.shards = shards
+        self.ready = False
+        self.received = 0
+        self.rejected = 0
+        self.overloaded = 0
+        self.malformed = 0
+        self._httpd = None
+        self._thread = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook = self
+        # The real port, in case port 0 was asked for
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="webhook", daemon=True
+        )
+        self._thread.start()
+        logger.info("Listening for updates on %s:%d%s", self.listen, self.port, self.path)
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = None
+
+    # Updater.stop() shuts down its httpd before it stops the dispatcher,
+    # which handles what was queued until then
+    shutdown = stop
+
+    def is_ready(self) -> bool:
+        return self.ready and self.dispatcher.running
+
+    def submit(self, data, forwarded_by=None) -> bool:
+        """
+        Queues an update, returns False if the queue is full or the
+        dispatcher isn't running (Telegram delivers it again later). Raises
+        ValueError if data isn't an update.
+        """
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            raise ValueError("not an object with an update_id")
+        try:
+            update = Update.de_json(data, self.dispatcher.bot)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError("can't read the update: %r" % e) from e
+        queue = self.dispatcher.update_queue
+        if queue.qsize() >= self.max_queue or not self.dispatcher.running:
+            self.overloaded += 1
+            return False
+        self.received += 1
+        if self.shards is None or self.shards.accept(update, data, forwarded_by):
+            queue.put(update)
+        return True
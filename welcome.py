@@ -9,28 +9,184 @@ Greets new users & keeps track of which chats the bot is in.
 Usage:
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
+
+By default the bot polls Telegram for updates. Run
+    python welcome.py --webhook --webhook-url https://example.org/telegram
+to receive them on a local HTTP server instead, see --help for all options.
 """
 
+# First, so the startup report covers every import
+import startup
+import argparse
 import logging
+import os
+import threading
 from typing import Tuple, Optional
 from time import sleep
 import traceback
 import sys
 from html import escape
-import pickledb
-from telegram import Update, Chat, ChatMember, ParseMode, ChatMemberUpdated, TelegramError
+from telegram import (
+    Update,
+    Chat,
+    ChatMember,
+    ParseMode,
+    ChatMemberUpdated,
+    TelegramError,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
+from telegram.error import Unauthorized
+from telegram.utils.request import Request
+from queue import Queue
 from telegram.ext import (
     Updater,
+    ExtBot,
+    JobQueue,
     MessageHandler,
     Filters,
     CommandHandler,
     CallbackContext,
     ChatMemberHandler,
+    CallbackQueryHandler,
+    TypeHandler,
+    DispatcherHandlerStop,
 )
+import storage
+from settings import SettingsCache
+from batching import JOIN, LEAVE, MemberBuffer, join_names
+import outbox
+from aiobot import AsyncSendScheduler
+from autodelete import MAX_TTL, DeletionQueue
+from webhook import WebhookServer
+from lanes import LaneDispatcher
+from sharding import ShardCoordinator
+from registry import ChatRegistry, PageCache
+from reports import RecentReports
+from broadcast import Broadcast
+from maintenance import Maintenance
+from admins import AdminCache
+from dedup import UpdateFilter
+import raids
+from metrics import REGISTRY, MetricsServer, timed
+
+startup.TIMER.done("imports")
 
 #Enter your telegram bot token from bot father
-#between the quotes
-TOKEN = ""
+#between the quotes (or set WELCOME_TOKEN)
+TOKEN = os.environ.get("WELCOME_TOKEN", "")
+
+# Where settings are stored. A plain path is the JSON file pickledb used to
+# write plus an append-only journal next to it, "sqlite:<path>" keeps them in
+# SQLite instead. An existing bot.db is imported into a new SQLite database.
+DATABASE = os.environ.get("WELCOME_DATABASE", "bot.db")
+# Read a "bot.db" store in a background thread, so the bot already connects
+# to Telegram while it loads. Handlers wait for it on their first access.
+DATABASE_LAZY = os.environ.get("WELCOME_LAZY_DATABASE") == "1"
+
+# How many chats keep their settings cached in memory
+SETTINGS_CACHE_SIZE = 10000
+
+# Greetings sent in batch mode (/batch) name at most this many members
+BATCH_MAX_NAMES = 20
+# Window used by /batch when no number of seconds is given, and its limits
+BATCH_DEFAULT_WINDOW = 3
+BATCH_MAX_WINDOW = 60
+
+# Outgoing messages per second for the whole bot and per minute for a group
+SEND_GLOBAL_RATE = float(os.environ.get("WELCOME_SEND_GLOBAL_RATE", "30"))
+SEND_GROUP_RATE = float(os.environ.get("WELCOME_SEND_GROUP_RATE", "20"))
+# Threads doing the HTTP calls for outgoing messages
+SEND_WORKERS = 4
+# Send and delete messages as coroutines on one event loop instead of on
+# SEND_WORKERS threads, with at most SEND_CONNECTIONS requests at once
+SEND_ASYNCIO = os.environ.get("WELCOME_ASYNCIO") == "1"
+SEND_CONNECTIONS = 100
+
+# Seconds after which the bot deletes its messages, unless a chat changed it
+# with /autodelete, how often due messages are deleted and the threads
+# deleting them
+AUTO_DELETE_AFTER = 30
+AUTO_DELETE_INTERVAL = 1
+AUTO_DELETE_WORKERS = 8
+
+# Seconds during which further reports of the same message are ignored
+REPORT_WINDOW = 300
+
+# A chat is raided when RAID_JOINS members join within RAID_WINDOW seconds
+# (0 turns this off). Until no such spike was seen for RAID_COOLDOWN seconds,
+# joins (and leaves, e.g. the raiders being kicked) are announced with one
+# message per RAID_BATCH_WINDOW seconds, or not at all with RAID_SUPPRESS.
+# RAID_NOTIFY tells the report subscribers once.
+RAID_JOINS = 10
+RAID_WINDOW = 10
+RAID_COOLDOWN = 60
+RAID_BATCH_WINDOW = 30
+RAID_SUPPRESS = False
+RAID_NOTIFY = True
+
+# Who may change the settings of a locked chat: "inviter" (the user who
+# added the bot) or "admins" (the inviter and every admin of the group)
+ADMIN_POLICY = os.environ.get("WELCOME_ADMIN_POLICY", "inviter")
+# Seconds after which the cached admins of a chat are loaded again, and the
+# number of chats whose admins are kept
+ADMIN_CACHE_TTL = 60 * 60
+ADMIN_CACHE_SIZE = 10000
+
+# User ids allowed to /broadcast to every group, comma separated in
+# WELCOME_ADMINS
+ADMINS = {int(i) for i in os.environ.get("WELCOME_ADMINS", "").split(",") if i.strip()}
+# Groups queued at once by a broadcast, progress is saved after each page
+BROADCAST_PAGE_SIZE = 100
+# Seconds between progress reports to the admin running a broadcast
+BROADCAST_REPORT_INTERVAL = 60
+
+# Seconds between maintenance runs, which drop the settings of chats the
+# bot left and rewrite the store, 0 to disable. Settings are kept for
+# MAINTENANCE_GRACE_PERIOD seconds after the bot was removed from a group.
+# When sharded, only the live instance with the lowest SHARD_ID runs it.
+MAINTENANCE_INTERVAL = 24 * 60 * 60
+MAINTENANCE_GRACE_PERIOD = 7 * 24 * 60 * 60
+
+# Updates already handled are dropped, the ids of the last DEDUP_SIZE are
+# saved every DEDUP_SAVE_INTERVAL seconds. A member joining (or leaving)
+# again within DEDUP_FLAP_WINDOW seconds isn't greeted again, 0 to disable.
+DEDUP_SIZE = 4096
+DEDUP_SAVE_INTERVAL = 10
+DEDUP_FLAP_WINDOW = 10
+
+# Webhook mode, all of these can be changed on the command line as well.
+# The server speaks plain HTTP, put a reverse proxy terminating TLS in front
+# of it and pass the public URL as WEBHOOK_URL.
+WEBHOOK_URL = os.environ.get("WELCOME_WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WELCOME_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WELCOME_WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WELCOME_WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WELCOME_WEBHOOK_SECRET", "")
+# Updates waiting for the dispatcher before the webhook answers 503
+WEBHOOK_MAX_QUEUE = 1000
+
+# Threads processing updates. Updates of one chat always go to the same
+# thread, so they are still handled in order. 1 keeps the single dispatcher
+# thread of python-telegram-bot.
+DISPATCH_LANES = int(os.environ.get("WELCOME_LANES", "1"))
+# Updates a lane may have waiting before the dispatcher stops reading more
+LANE_MAX_BACKLOG = 1000
+
+# Run several instances in webhook mode that split the chats between them.
+# Each one needs a unique SHARD_ID that stays the same across restarts and
+# the URL the others can post updates to (its webhook server on the
+# internal network), and all of them the same "sqlite:" DATABASE.
+SHARD_ID = os.environ.get("WELCOME_SHARD_ID", "")
+SHARD_URL = os.environ.get("WELCOME_SHARD_URL", "")
+
+# Port of a local server answering GET /metrics while polling, 0 for none.
+# In webhook mode the metrics are served by the webhook server.
+METRICS_PORT = int(os.environ.get("WELCOME_METRICS_PORT", "0"))
+
+# Groups listed per /show_chats page, and the length titles are cut to
+SHOW_CHATS_PAGE_SIZE = 25
+CHAT_TITLE_LENGTH = 100
 
 # Enable logging
 logging.basicConfig(
@@ -40,9 +196,76 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Create database object
-db = pickledb.load("bot.db", True)
-if not db.get("chats"):
-    db.set("chats", [])
+db = storage.open_store(
+    DATABASE, migrate_from="bot.db", lazy=DATABASE_LAZY, shared=bool(SHARD_ID)
+)
+# Groups the bot is a member of, users that started it and channels it
+# administers
+chats = ChatRegistry(db, shard=SHARD_ID or None)
+users = ChatRegistry(db, "user:", "user_count", SHARD_ID or None)
+channels = ChatRegistry(db, "channel:", "channel_count", SHARD_ID or None)
+# Users who blocked the bot since the last maintenance run
+blocked_users = ChatRegistry(db, "blocked:", "blocked_count", SHARD_ID or None)
+# Groups the bot was removed from, whose settings maintenance drops
+left_chats = ChatRegistry(db, "left:", "left_count", SHARD_ID or None)
+# Pages shown by /show_chats
+chat_pages = PageCache(chats, SHOW_CHATS_PAGE_SIZE)
+chat_settings = SettingsCache(db, SETTINGS_CACHE_SIZE)
+# Admins of the groups, for ADMIN_POLICY = "admins"
+chat_admins = AdminCache(ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+# Members waiting for a batched greeting
+member_buffer = MemberBuffer(BATCH_MAX_NAMES)
+# Every message goes out through this rate limited queue
+sender = outbox.SendScheduler(
+    global_rate=SEND_GLOBAL_RATE,
+    group_rate=SEND_GROUP_RATE / 60,
+    workers=SEND_WORKERS,
+)
+# Messages waiting to be deleted
+deletions = DeletionQueue(
+    db,
+    "autodelete:" + SHARD_ID if SHARD_ID else "autodelete",
+    load=False,
+    workers=AUTO_DELETE_WORKERS,
+)
+# Updates handled recently, to drop repeated ones
+update_filter = UpdateFilter(
+    # extract_status_change is defined further down
+    lambda change: extract_status_change(change),
+    db,
+    "dedup:" + SHARD_ID if SHARD_ID else "dedup",
+    DEDUP_SIZE,
+    DEDUP_FLAP_WINDOW,
+)
+# Recently reported messages
+recent_reports = RecentReports(REPORT_WINDOW)
+# Join rates of the chats
+raid_detector = raids.RaidDetector(RAID_JOINS, RAID_WINDOW, RAID_COOLDOWN)
+# Garbage collection of the store
+maintenance = Maintenance(
+    db,
+    chats,
+    left_chats,
+    blocked_users,
+    [chats, users, channels, blocked_users, left_chats],
+    on_changed=chat_settings.invalidate,
+    grace_period=MAINTENANCE_GRACE_PERIOD,
+    # Vacuuming the shared database would lock out every instance
+    rewrite=not SHARD_ID,
+)
+# Set once load_state() read what the handlers need, updates wait for it
+state_loaded = threading.Event()
+# Announcement to every group, sent in the background
+broadcasts = Broadcast(
+    db,
+    chats,
+    sender,
+    "broadcast:" + SHARD_ID if SHARD_ID else "broadcast",
+    BROADCAST_PAGE_SIZE,
+    report_interval=BROADCAST_REPORT_INTERVAL,
+)
+
+startup.TIMER.done("open store")
 
 help_text = (
     "Welcomes everyone that enters a group chat that this bot is a "
@@ -56,7 +279,10 @@ help_text = (
     '/quiet - Disable "Sorry, only the person who..." '
     "& help messages\n"
     '/unquiet - Enable "Sorry, only the person who..." '
-    "& help messages\n\n"
+    "& help messages\n"
+    "/batch - Greet everyone who joins within a few seconds with one message\n"
+    "/unbatch - Greet every new member separately\n"
+    "/autodelete - Seconds after which my messages are deleted, 0 keeps them\n\n"
     "You can use $username and $title as placeholders when setting"
     " messages. [HTML formatting]"
     "(https://core.telegram.org/bots/api#formatting-options) "
@@ -71,11 +297,23 @@ help_text = (
 Create database object
 Database schema:
 <chat_id> -> welcome message
-<chat_id>_bye -> goodbye message
+<chat_id>_bye -> goodbye message, null if it was disabled
 <chat_id>_adm -> user id of the user who invited the bot
 <chat_id>_lck -> boolean if the bot is locked or unlocked
 <chat_id>_quiet -> boolean if the bot is quieted
-chats -> list of chat ids where the bot has received messages in.
+<chat_id>_title -> title of the group
+<chat_id>_reports -> list of user ids that receive report notifications
+<chat_id>_batch -> seconds joins and leaves are collected for one message, false if disabled
+<chat_id>_ttl -> seconds after which the bot deletes its messages, 0 to keep them
+chat:<chat_id> -> type, title, join time and last activity of a group the bot is in
+chat_count -> number of chat:<chat_id> rows
+user:<user_id>, user_count -> the same for users who started the bot
+channel:<chat_id>, channel_count -> the same for channels the bot administers
+blocked:<user_id>, blocked_count -> users who blocked the bot since the last maintenance run
+left:<chat_id>, left_count -> groups the bot was removed from, maintenance drops their settings
+autodelete:<minute> -> list of [due timestamp, chat id, message id] the bot still has to delete
+broadcast -> text, position and counts of an unfinished broadcast
+dedup -> ids of the updates handled last
 """
 
 def extract_status_change(
@@ -113,6 +351,7 @@ def extract_status_change(
 
     return was_member, is_member
 
+@timed
 def track_chats(update: Update, context: CallbackContext) -> None:
     """Tracks the chats the bot is in."""
     result = extract_status_change(update.my_chat_member)
@@ -129,113 +368,160 @@ def track_chats(update: Update, context: CallbackContext) -> None:
     if chat.type == Chat.PRIVATE:
         if not was_member and is_member:
             logger.info("%s started the bot", cause_name)
-            context.bot_data.setdefault("user_ids", set()).add(chat.id)
+            users.add(chat.id, chat.type, None)
+            blocked_users.remove(chat.id)
         elif was_member and not is_member:
             logger.info("%s blocked the bot", cause_name)
-            context.bot_data.setdefault("user_ids", set()).discard(chat.id)
+            users.remove(chat.id)
+            # Maintenance drops them from the report lists
+            blocked_users.add(chat.id, chat.type, None)
     elif chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
         if not was_member and is_member:
             logger.info("%s added the bot to the group %s", cause_name, chat.title)
-            context.bot_data.setdefault("group_ids", set()).add(chat.id)
-            db.set(str(chat_id) + "_adm", update.effective_user.id)
-            db.set(str(chat_id) + "_lck", True)
-            db.set(str(chat_id) + "_quiet", False)
-            db.set(str(chat_id) + "_title", chat.title)
-            # Keep chatlist
-            chats = db.get("chats")
-            if str(chat_id) not in chats:
-                chats.append(str(chat_id))
-                db.set("chats", chats)
+            # Keep chatlist, before the settings so maintenance keeps them
+            if chats.add(chat_id, chat.type, chat.title):
                 logger.info("I have been added to %d chats" % len(chats))
+            left_chats.remove(chat_id)
+            chat_settings.update(
+                chat_id,
+                adm=update.effective_user.id,
+                locked=True,
+                quiet=False,
+                title=chat.title,
+            )
         elif was_member and not is_member:
             logger.info("%s removed the bot from the group %s", cause_name, chat.title)
-            context.bot_data.setdefault("group_ids", set()).discard(chat.id)
-            chats = db.get("chats")
-            chats.remove(str(chat_id))
-            db.set("chats", chats)
-            logger.info("Removed chat_id %s from chat list" % chat_id)
+            remove_chat(chat_id)
+            # Only groups the bot really left have their settings dropped
+            left_chats.add(chat_id, chat.type, chat.title)
+            chat_admins.forget(chat_id)
     else:
         if not was_member and is_member:
             logger.info("%s added the bot to the channel %s", cause_name, chat.title)
-            context.bot_data.setdefault("channel_ids", set()).add(chat.id)
+            channels.add(chat.id, chat.type, chat.title)
         elif was_member and not is_member:
             logger.info("%s removed the bot from the channel %s", cause_name, chat.title)
-            context.bot_data.setdefault("channel_ids", set()).discard(chat.id)
-
+            channels.remove(chat.id)
+
+def render_chats(rows):
+    """One page of the group titles shown by /show_chats"""
+    titles = []
+    for chat_id, row in rows:
+        title = row["title"] or str(chat_id)
+        if len(title) > CHAT_TITLE_LENGTH:
+            title = title[:CHAT_TITLE_LENGTH - 1] + "…"
+        titles.append(title)
+    return "\n".join(titles)
+
+def chats_page(context, number):
+    """Text and navigation buttons of a /show_chats page"""
+    number, titles, has_next = chat_pages.get(number, render_chats)
+    text = (
+        f"@{context.bot.username} has started a conversation with {len(users)} users\n"
+        f"Moreover it has become a member of {len(chats)} groups\n"
+        f"and administrator in {len(channels)} channels\n\n"
+        f"Group Titles active in the database, page {number + 1}:\n"
+        f"{titles}"
+    )
+    buttons = []
+    if number > 0:
+        buttons.append(InlineKeyboardButton("« Previous", callback_data=f"chats:{number - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=f"chats:{number + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@timed
 def show_chats(update: Update, context: CallbackContext) -> None:
     """Shows which chats the bot is in"""
-    user_ids = ", ".join(str(uid) for uid in context.bot_data.setdefault("user_ids", set()))
-    group_ids = ", ".join(str(gid) for gid in context.bot_data.setdefault("group_ids", set()))
-    channel_ids = ", ".join(str(cid) for cid in context.bot_data.setdefault("channel_ids", set()))
-    text = (
-        f"As of the last script initilization, @{context.bot.username} has started a conversation with the user IDs: {user_ids}\n"
-        f"Moreover it has become a member of the groups with IDs: {group_ids}\n"
-        f"and administrator in the channels with IDs: {channel_ids}\n\n"
-        f"Group Titles active in the database:\n"
-    )
-    list = db.get("chats")
-    for group in list:
-        title = db.get(str(group) + "_title")
-        text = f"{text}{title}\n"
-    a = update.effective_message.reply_text(text)
-    mess = []
-    mess.append(update.effective_chat.id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    text, markup = chats_page(context, 0)
+    reply(
+        update.effective_chat.id,
+        text,
+        reply_to_message_id=update.effective_message.message_id,
+        reply_markup=markup,
+    )
+
+@timed
+def show_chats_page(update: Update, context: CallbackContext) -> None:
+    """Switches the /show_chats message to another page"""
+    query = update.callback_query
+    text, markup = chats_page(context, int(context.match.group(1)))
+    query.answer()
+    if text != query.message.text:
+        query.edit_message_text(text, reply_markup=markup)
 
+@timed
 def receive_reports(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     if chat_id > 0:
-        update.effective_chat.send_message("Please send this command in a group!")
+        sender.send(chat_id, "Please send this command in a group!", outbox.NOTICE)
         return
-    if not db.get(str(chat_id) + "_reports"):
-        db.set(str(chat_id) + "_reports", [])
-    list = db.get(str(chat_id) + "_reports")
+    list = chat_settings.get(chat_id).reports or []
     if user_id not in list:
-        list.append(user_id)
-        db.set(str(chat_id) + "_reports", list)
-        a = update.effective_chat.send_message("Added! You will receive report notifications in a private chat with me!")
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
+        chat_settings.update(chat_id, reports=list + [user_id])
+        reply(chat_id, "Added! You will receive report notifications in a private chat with me!")
 
+@timed
 def stop_reports(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     if chat_id > 0:
-        update.effective_chat.send_message("Please send this command in a group!")
+        sender.send(chat_id, "Please send this command in a group!", outbox.NOTICE)
         return
-    if not db.get(str(chat_id) + "_reports"):
+    list = chat_settings.get(chat_id).reports
+    if not list:
         return
-    list = db.get(str(chat_id) + "_reports")
     if user_id in list:
-        list.remove(user_id)
-        db.set(str(chat_id) + "_reports", list)
-        a = update.effective_chat.send_message("You will no longer receive notifications of reports.")
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
+        chat_settings.update(chat_id, reports=[uid for uid in list if uid != user_id])
+        reply(chat_id, "You will no longer receive notifications of reports.")
 
+@timed
 def report(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     title = update.effective_chat.title
     if chat_id > 0:
         return
-    list = db.get(str(chat_id) + "_reports")
-    for user in list:
-        context.bot.send_message(user, f"Message reported in the group: {title}")
-    a = update.effective_chat.send_message("Reported!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
 
+    # Reports of the same message (or by the same user, if they didn't reply
+    # to one) only notify the subscribers once per REPORT_WINDOW
+    reported = update.message.reply_to_message
+    key = (chat_id, reported.message_id) if reported else (chat_id, "user", user_id)
+    if recent_reports.first(key):
+        text = f"Message reported in the group: {title}"
+        if reported and reported.link:
+            text = f"{text}\n{reported.link}"
+        notify_subscribers(chat_id, text)
+    reply(chat_id, "Reported!")
+
+def notify_subscribers(chat_id, text):
+    """Sends text to everyone on the report list of chat_id"""
+    on_error = unsubscribe_failed(chat_id)
+    for user in chat_settings.get(chat_id).reports or []:
+        sender.send(user, text, outbox.REPORT, on_error=on_error)
+
+def unsubscribe_failed(chat_id):
+    """
+    Returns an error callback for report notifications, which removes users
+    that blocked the bot from the report list of chat_id.
+    """
+
+    def failed(user_id, error):
+        if not chat_unreachable(error):
+            send_failed(user_id, error)
+            return
+        list = chat_settings.get(chat_id).reports or []
+        if user_id in list:
+            chat_settings.update(chat_id, reports=[uid for uid in list if uid != user_id])
+            logger.info("Removed %s from the report list of %s" % (user_id, chat_id))
+
+    return failed
+
+@timed
 def greet_chat_members(update: Update, context: CallbackContext) -> None:
     """Greets new users in chats and announces when someone leaves"""
+    chat_admins.member_changed(update.chat_member)
     result = extract_status_change(update.chat_member)
     if result is None:
         return
@@ -248,57 +534,123 @@ def greet_chat_members(update: Update, context: CallbackContext) -> None:
 
     title = update.effective_chat.title
     chat_id = update.effective_chat.id
-    chat_str = str(chat_id)
+    settings = chat_settings.get(chat_id)
+    register_chat(update.effective_chat)
 
     if not was_member and is_member:
-        # Pull the custom message for this chat from the database
-        text = db.get(chat_str)
-        # Use default message if there's no custom one set
-        if text is False:
-            text = "Hello $username! Welcome to $title"
-
-        # Replace placeholders and send message
-        text = text.replace("$username", username)
-        text = text.replace("$title", title)
-        text = text.replace("$n", "\n")
-
-        a = update.effective_chat.send_message(
+        raid = raid_detector.join(chat_id)
+        if raid == raids.STARTED:
+            logger.info("Raid in %s (%s)", title, chat_id)
+            if RAID_NOTIFY:
+                notify_subscribers(
+                    chat_id,
+                    f"Raid in the group {title}: {RAID_JOINS} members joined within "
+                    f"{RAID_WINDOW} seconds. Greetings are "
+                    + ("off" if RAID_SUPPRESS else "batched")
+                    + " until it calms down.",
+                )
+        if raid != raids.NORMAL:
+            if RAID_SUPPRESS:
+                return
+            if member_buffer.add(chat_id, JOIN, username):
+                context.job_queue.run_once(
+                    flush_members, RAID_BATCH_WINDOW, context=[chat_id, JOIN, title]
+                )
+            return
+
+        if settings.batch:
+            # Greet everyone joining during the window at once
+            if member_buffer.add(chat_id, JOIN, username):
+                context.job_queue.run_once(
+                    flush_members, settings.batch, context=[chat_id, JOIN, title]
+                )
+            return
+
+        # Fill the (cached) welcome message of this chat and send it
+        text = settings.welcome_template().render(username, title)
+
+        reply(
+            chat_id,
             text,
+            outbox.GREETING,
             parse_mode=ParseMode.HTML,
         )
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
 
     elif was_member and not is_member:
-        # Pull the custom message for this chat from the database
-        text = db.get(chat_str + "_bye")
+        template = settings.bye_template()
         # Goodbye was disabled
-        if text is None:
+        if template is None:
+            return
+
+        # Admins kicking the raiders, one goodbye each would flood the chat
+        if raid_detector.raided(chat_id):
+            if RAID_SUPPRESS:
+                return
+            if member_buffer.add(chat_id, LEAVE, username):
+                context.job_queue.run_once(
+                    flush_members, RAID_BATCH_WINDOW, context=[chat_id, LEAVE, title]
+                )
             return
 
-        # Use default message if there's no custom one set
-        if text is False:
-            text = "Goodbye, $username!"
+        if settings.batch:
+            if member_buffer.add(chat_id, LEAVE, username):
+                context.job_queue.run_once(
+                    flush_members, settings.batch, context=[chat_id, LEAVE, title]
+                )
+            return
 
-        # Replace placeholders and send message
-        text = text.replace("$username", username)
-        text = text.replace("$title", title)
-        text = text.replace("$n", "\n")
+        text = template.render(username, title)
 
-        a = update.effective_chat.send_message(
+        reply(
+            chat_id,
             text,
+            outbox.GREETING,
             parse_mode=ParseMode.HTML,
         )
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
 
-def rm_message(context):
-    context.bot.deleteMessage(context.job.context[0], context.job.context[1])
+@timed
+def flush_members(context):
+    """Sends one greeting or goodbye for all members buffered in batch mode"""
+    chat_id, kind, title = context.job.context
+    names, count = member_buffer.pop(chat_id, kind)
+    if not count:
+        return
+
+    settings = chat_settings.get(chat_id)
+    if kind == JOIN:
+        template = settings.welcome_template()
+    else:
+        template = settings.bye_template()
+        # Goodbye was disabled while the window was open
+        if template is None:
+            return
 
+    text = template.render(join_names(names, count), title)
+
+    reply(chat_id, text, outbox.GREETING, parse_mode=ParseMode.HTML)
+
+def reply(chat_id, text, priority=outbox.CONFIRMATION, **kwargs):
+    """Queues a message that deletes itself after the chat's auto-delete time"""
+    ttl = chat_settings.get(chat_id).ttl
+    if ttl is False:
+        ttl = AUTO_DELETE_AFTER
+    # Telegram doesn't delete older messages, chats may have set more before
+    ttl = min(ttl, MAX_TTL)
+
+    def delete_later(message):
+        deletions.add(chat_id, message.message_id, ttl)
+
+    sender.send(chat_id, text, priority, on_sent=delete_later if ttl else None, **kwargs)
+
+@timed
+def delete_messages(context):
+    """Deletes the bot's messages that are due"""
+    if isinstance(sender, AsyncSendScheduler):
+        sender.run(deletions.run_async(sender.api))
+    else:
+        deletions.run(context.bot)
+
+@timed
 def check(update, context, override_lock=None):
     """
     Perform some checks on the update. If checks were successful, returns True,
@@ -306,45 +658,52 @@ def check(update, context, override_lock=None):
     """
 
     chat_id = update.effective_chat.id
-    chat_str = str(chat_id)
 
     if chat_id > 0:
-        update.effective_chat.send_message(
-            "Please add me to a group first!",
-        )
+        sender.send(chat_id, "Please add me to a group first!", outbox.NOTICE)
         return False
 
-    locked = override_lock if override_lock is not None else db.get(chat_str + "_lck")
-
-    if locked and db.get(chat_str + "_adm") != update.message.from_user.id:
-        if db.get(chat_str + "_quiet") == False:
-            a = update.effective_chat.send_message(
-                "Sorry, only the person who invited me can do that.",
+    register_chat(update.effective_chat)
+    settings = chat_settings.get(chat_id)
+    locked = override_lock if override_lock is not None else settings.locked
+
+    if locked and not may_manage(update, context):
+        if settings.quiet == False:
+            reply(
+                chat_id,
+                "Sorry, only the person who invited me can do that."
+                if ADMIN_POLICY != "admins"
+                else "Sorry, only admins can do that.",
+                outbox.NOTICE,
             )
-            mess = []
-            mess.append(chat_id)
-            mess.append(a.message_id)
-            context.job_queue.run_once(rm_message, 30, context=mess)
         return False
 
     return True
 
+def may_manage(update, context) -> bool:
+    """True if the sender of a command may change the settings of its chat"""
+    chat_id = update.effective_chat.id
+    message = update.message
+    if chat_settings.get(chat_id).adm == message.from_user.id:
+        return True
+    if ADMIN_POLICY != "admins":
+        return False
+    # Anonymous admins write as the group itself
+    if message.sender_chat is not None and message.sender_chat.id == chat_id:
+        return True
+    return chat_admins.is_admin(context.bot, chat_id, message.from_user.id)
+
 # Print help text
+@timed
 def help(update, context):
     """ Prints help text """
     chat_id = update.effective_chat.id
-    chat_str = str(chat_id)
-    if (
-        db.get(chat_str + "_quiet") == False
-        or db.get(chat_str + "_adm") == update.message.from_user.id
-    ):
-        a = update.effective_chat.send_message(help_text, disable_web_page_preview=True)
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
+    settings = chat_settings.get(chat_id)
+    if settings.quiet == False or may_manage(update, context):
+        reply(chat_id, help_text, outbox.NOTICE, disable_web_page_preview=True)
 
 # Set custom message
+@timed
 def set_welcome(update, context):
     """ Sets custom welcome message """
 
@@ -359,28 +718,22 @@ def set_welcome(update, context):
 
     # Only continue if there's a message
     if not message:
-        a = update.effective_chat.send_message(
+        reply(
+            chat_id,
             text="You need to send a message, too! For example:\n"
             "<code>/welcome Hello $username, welcome to "
             "$title!</code>",
             parse_mode=ParseMode.HTML,
         )
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
         return
 
     # Put message into database
-    db.set(str(chat_id), message)
+    chat_settings.update(chat_id, welcome=message)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
 # Set custom message
+@timed
 def set_goodbye(update, context):
     """ Enables and sets custom goodbye message """
 
@@ -395,26 +748,20 @@ def set_goodbye(update, context):
 
     # Only continue if there's a message
     if not message:
-        a = update.effective_chat.send_message(
+        reply(
+            chat_id,
             text="You need to send a message, too! For example:\n"
             "<code>/goodbye Goodbye, $username!</code>",
             parse_mode=ParseMode.HTML,
         )
-        mess = []
-        mess.append(chat_id)
-        mess.append(a.message_id)
-        context.job_queue.run_once(rm_message, 30, context=mess)
         return
 
     # Put message into database
-    db.set(str(chat_id) + "_bye", message)
+    chat_settings.update(chat_id, bye=message)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
+@timed
 def disable_goodbye(update, context):
     """ Disables the goodbye message """
 
@@ -424,15 +771,13 @@ def disable_goodbye(update, context):
     if not check(update, context):
         return
 
-    # Disable goodbye message
-    db.set(str(chat_id) + "_bye", False)
+    # Disable goodbye message. False means "not set" and falls back to the
+    # default message, a disabled goodbye is stored as None
+    chat_settings.update(chat_id, bye=None)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
+@timed
 def lock(update, context):
     """ Locks the chat, so only the invitee can change settings """
 
@@ -443,14 +788,11 @@ def lock(update, context):
         return
 
     # Lock the bot for this chat
-    db.set(str(chat_id) + "_lck", True)
+    chat_settings.update(chat_id, locked=True)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
+@timed
 def quiet(update, context):
     """ Quiets the chat, so no error messages will be sent """
 
@@ -461,14 +803,11 @@ def quiet(update, context):
         return
 
     # Lock the bot for this chat
-    db.set(str(chat_id) + "_quiet", True)
+    chat_settings.update(chat_id, quiet=True)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
+@timed
 def unquiet(update, context):
     """ Unquiets the chat """
 
@@ -479,14 +818,85 @@ def unquiet(update, context):
         return
 
     # Unquiet the bot for this chat
-    db.set(str(chat_id) + "_quiet", False)
+    chat_settings.update(chat_id, quiet=False)
+
+    reply(chat_id, "Got it!")
+
+@timed
+def batch(update, context):
+    """ Greets members joining within a few seconds with one message """
+
+    chat_id = update.effective_chat.id
+
+    # Check admin privilege and group context
+    if not check(update, context):
+        return
+
+    try:
+        window = int(context.args[0]) if context.args else BATCH_DEFAULT_WINDOW
+    except ValueError:
+        window = 0
+    if not 1 <= window <= BATCH_MAX_WINDOW:
+        reply(
+            chat_id,
+            "Please give a number of seconds between 1 and %d." % BATCH_MAX_WINDOW
+        )
+        return
+
+    chat_settings.update(chat_id, batch=window)
+
+    reply(chat_id, "Got it!")
+
+@timed
+def unbatch(update, context):
+    """ Greets every new member with their own message """
+
+    chat_id = update.effective_chat.id
+
+    # Check admin privilege and group context
+    if not check(update, context):
+        return
+
+    chat_settings.update(chat_id, batch=False)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
 
+@timed
+def autodelete(update, context):
+    """ Sets after how many seconds the bot deletes its messages """
+
+    chat_id = update.effective_chat.id
+
+    # Check admin privilege and group context
+    if not check(update, context):
+        return
+
+    try:
+        ttl = int(context.args[0])
+    except (IndexError, ValueError):
+        ttl = -1
+    if ttl < 0:
+        reply(
+            chat_id,
+            text="You need to give a number of seconds, too! For example:\n"
+            "<code>/autodelete 60</code>, or <code>/autodelete 0</code> to keep "
+            "my messages.",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+    if ttl > MAX_TTL:
+        reply(
+            chat_id,
+            "Telegram only lets me delete messages for 48 hours, so I can wait "
+            "%d seconds (%d hours) at most." % (MAX_TTL, MAX_TTL // 3600),
+        )
+        return
+
+    chat_settings.update(chat_id, ttl=ttl)
+
+    reply(chat_id, "Got it!")
+
+@timed
 def unlock(update, context):
     """ Unlocks the chat, so everyone can change settings """
 
@@ -497,13 +907,99 @@ def unlock(update, context):
         return
 
     # Unlock the bot for this chat
-    db.set(str(chat_id) + "_lck", False)
+    chat_settings.update(chat_id, locked=False)
 
-    a = update.effective_chat.send_message("Got it!")
-    mess = []
-    mess.append(chat_id)
-    mess.append(a.message_id)
-    context.job_queue.run_once(rm_message, 30, context=mess)
+    reply(chat_id, "Got it!")
+
+@timed
+def maintain(context):
+    """Cleans up the store, in a job queue thread so updates keep flowing"""
+    shards = context.job.context
+    # The instances share the store, one of them cleans it up
+    if shards is not None and not shards.is_leader():
+        return
+    maintenance.run()
+
+@timed
+def broadcast(update, context):
+    """
+    Sends a message to every group the bot is in. Only for ADMINS, in a
+    private chat. Without text it shows the progress, /broadcast stop,
+    resume and cancel control a running broadcast.
+    """
+    chat_id = update.effective_chat.id
+    user_id = update.message.from_user.id
+    if chat_id < 0 or user_id not in ADMINS:
+        return
+
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        answer = broadcasts.progress()
+    elif text == "stop":
+        broadcasts.stop(wait=False)
+        answer = "Pausing after the current page, /broadcast resume continues."
+    elif text == "resume":
+        answer = "Resumed." if broadcasts.start() else broadcasts.progress()
+    elif text == "cancel":
+        answer = "Cancelled." if broadcasts.cancel() else "No broadcast is running"
+    elif broadcasts.start(text, user_id):
+        answer = "Broadcasting to %d groups, I'll keep you posted." % len(chats)
+    else:
+        answer = "Another broadcast isn't finished yet, /broadcast cancel drops it.\n"
+        answer += broadcasts.progress()
+    sender.send(chat_id, answer, outbox.NOTICE)
+
+def broadcast_failed(chat_id, error) -> bool:
+    """Removes groups a broadcast can't reach, returns True if it did"""
+    if chat_unreachable(error):
+        remove_chat(chat_id)
+        return True
+    logger.warning("Broadcast to %s failed (%s): %s", chat_id, type(error), error)
+    return False
+
+def broadcast_progress(by, text):
+    """Tells the admin who started a broadcast how it goes"""
+    if by is not None:
+        sender.send(by, text, outbox.NOTICE)
+
+def chat_unreachable(error) -> bool:
+    """True if error means the bot can't send messages to the chat anymore"""
+    return isinstance(error, Unauthorized) or (
+        isinstance(error, TelegramError)
+        and (
+            error.message == "Unauthorized"
+            or error.message == "Have no rights to send a message"
+            or "PEER_ID_INVALID" in error.message
+        )
+    )
+
+def register_chat(chat):
+    """
+    Records activity in a group. A group whose row was lost while the bot
+    is still in it (after a send error, a migration to a supergroup or a
+    join while the bot was offline) is registered again. Channels have
+    their own registry and aren't touched.
+    """
+    if chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+        return
+    if chats.touch(chat.id, chat.type, chat.title):
+        logger.info("Registered the active chat %s again", chat.id)
+        left_chats.remove(chat.id)
+
+def remove_chat(chat_id):
+    """Removes a chat the bot can't reach anymore from its registry"""
+    if chats.remove(chat_id):
+        logger.info("Removed chat_id %s from chat list" % chat_id)
+    elif users.remove(chat_id) or channels.remove(chat_id):
+        logger.info("Removed chat_id %s from the user/channel list" % chat_id)
+
+def send_failed(chat_id, error):
+    """ Error handling for messages sent through the queue """
+    if chat_unreachable(error):
+        remove_chat(chat_id)
+    else:
+        logger.error("Sending to %s failed (%s): %s" % (chat_id, type(error), error))
 
 def error(update, context, **kwargs):
     """ Error handling """
@@ -511,28 +1007,420 @@ def error(update, context, **kwargs):
     chat_id = update.effective_chat.id
 
     try:
-        if isinstance(error, TelegramError) and (
-            error.message == "Unauthorized"
-            or error.message == "Have no rights to send a message"
-            or "PEER_ID_INVALID" in error.message
-        ):
-            chats = db.get("chats")
-            chats.remove(str(chat_id))
-            db.set("chats", chats)
-            logger.info("Removed chat_id %s from chat list" % chat_id)
+        if chat_unreachable(error):
+            remove_chat(chat_id)
         else:
             logger.error("An error (%s) occurred: %s" % (type(error), error.message))
     except:
         pass
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Advanced welcome bot")
+    parser.add_argument(
+        "--webhook",
+        action="store_true",
+        default=os.environ.get("WELCOME_MODE") == "webhook",
+        help="receive updates on an HTTP server instead of polling",
+    )
+    parser.add_argument(
+        "--webhook-url",
+        default=WEBHOOK_URL,
+        help="public URL Telegram sends updates to, the webhook isn't set if empty",
+    )
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN, help="address to listen on")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="port to listen on")
+    parser.add_argument("--path", default=WEBHOOK_PATH, help="path updates are posted to")
+    parser.add_argument(
+        "--secret",
+        default=WEBHOOK_SECRET,
+        help="secret token Telegram has to send with every update",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=os.environ.get("WELCOME_BASE_URL"),
+        help="Bot API URL the token is appended to, for a local Bot API server",
+    )
+    parser.add_argument(
+        "--lanes",
+        type=int,
+        default=DISPATCH_LANES,
+        help="number of threads processing updates, hashed by chat",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        default=SEND_ASYNCIO,
+        help="send and delete messages as coroutines sharing one connection pool",
+    )
+    parser.add_argument(
+        "--broadcast",
+        nargs="?",
+        const="",
+        metavar="TEXT",
+        help="send TEXT to every group and exit, without TEXT resume the unfinished broadcast",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="serve /metrics on this port while polling, 0 to disable",
+    )
+    return parser.parse_args(argv)
+
+def start_webhook(updater, args):
+    """Starts the dispatcher behind our own webhook server"""
+    dispatcher = updater.dispatcher
+    shards = None
+    if SHARD_ID:
+        shards = ShardCoordinator(
+            db.location,
+            SHARD_ID,
+            SHARD_URL or "http://%s:%d%s" % (args.listen, args.port, args.path),
+            dispatcher.update_queue,
+            secret=args.secret,
+            on_rebalance=rebalance_shards,
+        ).start()
+    server = WebhookServer(
+        dispatcher,
+        listen=args.listen,
+        port=args.port,
+        path=args.path,
+        secret=args.secret,
+        max_queue=WEBHOOK_MAX_QUEUE,
+        metrics=REGISTRY,
+        shards=shards,
+    )
+    threading.Thread(target=dispatcher.start, name="dispatcher").start()
+    updater.job_queue.start()
+    server.start()
+
+    if args.webhook_url:
+        updater.bot.set_webhook(
+            args.webhook_url,
+            allowed_updates=Update.ALL_TYPES,
+            api_kwargs={"secret_token": args.secret} if args.secret else None,
+        )
+        logger.info("Webhook set to %s", args.webhook_url)
+    server.ready = True
+
+    # Lets updater.idle() stop the dispatcher and job queue on a signal,
+    # after the server stopped taking updates
+    updater.running = True
+    updater.httpd = server
+    return server
+
+def rebalance_shards():
+    """Chats may have moved here, forget what was cached about them"""
+    db.flush()
+    db.invalidate()
+    chat_settings.clear()
+    chat_admins.clear()
+
+def drop_handled(update, context):
+    """Stops updates that were handled before from reaching the other handlers"""
+    # Polling and the webhook start before the store is loaded, the
+    # redelivered updates come first
+    state_loaded.wait()
+    if not update_filter.accept(update):
+        raise DispatcherHandlerStop()
+
+def save_update_filter(context):
+    update_filter.save()
+
+def first_update(update, context):
+    """Reports how long it took until the first update was handled"""
+    if startup.TIMER.since_start("first update"):
+        logger.info("First update handled, startup took %s", startup.TIMER.report())
+
+def load_state():
+    """
+    Reads what the handlers need from the store, waits for a lazy store.
+    Until it is done, updates wait in drop_handled().
+    """
+    try:
+        chats.migrate("chats")
+        deletions.load()
+        update_filter.load()
+    finally:
+        state_loaded.set()
+
+def broadcast_metrics():
+    state = broadcasts.state
+    if state is None:
+        return None
+    done = Broadcast.done(state)
+    return {
+        ("sent",): state["sent"],
+        ("failed",): state["failed"],
+        ("pending",): max(state["total"] - done, 0),
+    }
+
+def register_metrics(updater, server=None):
+    """Exports the counters the bot's components keep"""
+    dispatcher = updater.dispatcher
+
+    def counter(name, help, func, labels=()):
+        REGISTRY.callback(name, help, func, "counter", labels)
+
+    REGISTRY.callback(
+        "welcome_updates_queued",
+        "Updates waiting for the dispatcher",
+        dispatcher.update_queue.qsize,
+    )
+    REGISTRY.callback(
+        "welcome_jobs_pending",
+        "Jobs scheduled on the job queue",
+        lambda: len(updater.job_queue.jobs()),
+    )
+
+    counter("welcome_sent_total", "Messages sent", lambda: sender.stats()["sent"])
+    counter(
+        "welcome_send_failed_total",
+        "Messages that couldn't be sent",
+        lambda: sender.stats()["failed"],
+    )
+    counter(
+        "welcome_send_retried_total",
+        "Messages retried after a flood limit",
+        lambda: sender.stats()["retried"],
+    )
+    counter(
+        "welcome_send_rate_limited_total",
+        "429 answers from Telegram",
+        lambda: sender.stats()["rate_limited"],
+    )
+    counter(
+        "welcome_send_dropped_total",
+        "Messages dropped because the queue was full or they waited too long",
+        lambda: {(p,): n for p, n in sender.stats()["dropped_by_priority"].items()},
+        ["priority"],
+    )
+    REGISTRY.callback(
+        "welcome_send_queue",
+        "Messages waiting to be sent",
+        lambda: {("ready",): sender.stats()["queued"], ("deferred",): sender.stats()["deferred"]},
+        labels=["state"],
+    )
+
+    REGISTRY.callback(
+        "welcome_autodelete_queue", "Messages waiting to be deleted", lambda: len(deletions)
+    )
+    counter("welcome_autodelete_deleted_total", "Messages deleted", lambda: deletions.deleted)
+    counter(
+        "welcome_autodelete_missing_total",
+        "Messages that were already gone",
+        lambda: deletions.missing,
+    )
+    counter("welcome_raids_total", "Raids detected", lambda: raid_detector.raids)
+    counter(
+        "welcome_raid_joins_total",
+        "Joins during raids, batched or not greeted",
+        lambda: raid_detector.raid_joins,
+    )
+    REGISTRY.callback(
+        "welcome_raid_tracked_chats",
+        "Chats with recent joins the raid detector keeps",
+        lambda: len(raid_detector),
+    )
+    counter(
+        "welcome_admin_cache_hits_total",
+        "Permission checks answered from the admin cache",
+        lambda: chat_admins.hits,
+    )
+    counter(
+        "welcome_admin_cache_loads_total",
+        "getChatAdministrators calls, by outcome",
+        lambda: {("ok",): chat_admins.loads, ("error",): chat_admins.load_errors},
+        labels=["result"],
+    )
+    REGISTRY.callback(
+        "welcome_admin_cache_chats", "Chats whose admins are cached", lambda: len(chat_admins)
+    )
+    counter(
+        "welcome_maintenance_runs_total", "Maintenance runs", lambda: maintenance.runs
+    )
+    counter(
+        "welcome_maintenance_removed_keys_total",
+        "Settings of chats the bot left that were dropped",
+        lambda: maintenance.removed_keys,
+    )
+    counter(
+        "welcome_maintenance_invalid_keys_total",
+        "Keys that don't fit the schema, found by maintenance",
+        lambda: maintenance.invalid_keys,
+    )
+    counter(
+        "welcome_maintenance_seconds_total",
+        "Time spent in maintenance runs",
+        lambda: maintenance.seconds,
+    )
+    counter(
+        "welcome_updates_dropped_total",
+        "Updates dropped as already handled, by reason",
+        lambda: {(reason,): count for reason, count in update_filter.dropped.items()},
+        labels=["reason"],
+    )
+    REGISTRY.callback(
+        "welcome_startup_seconds",
+        "Duration of the startup phases",
+        lambda: {(phase,): seconds for phase, seconds in startup.TIMER.phases.items()},
+        labels=["phase"],
+    )
+    REGISTRY.callback(
+        "welcome_broadcast_chats",
+        "Chats of the unfinished broadcast by state",
+        broadcast_metrics,
+        labels=["state"],
+    )
+    counter(
+        "welcome_reports_collapsed_total",
+        "Repeated reports that were ignored",
+        lambda: recent_reports.collapsed,
+    )
+    REGISTRY.callback(
+        "welcome_chats",
+        "Chats the bot knows",
+        lambda: {("group",): len(chats), ("user",): len(users), ("channel",): len(channels)},
+        labels=["type"],
+    )
+
+    counter("welcome_store_reads_total", "Keys read from the store", lambda: db.reads)
+    counter(
+        "welcome_store_writes_total", "Keys written to or deleted from the store", lambda: db.writes
+    )
+    REGISTRY.callback(
+        "welcome_store_pending", "Changes not flushed to disk yet", lambda: db.stats()["pending"]
+    )
+    counter("welcome_store_flushes_total", "Flushes to disk", lambda: db.flushes)
+    counter("welcome_store_flush_seconds_total", "Time spent flushing", lambda: db.flush_seconds)
+    counter(
+        "welcome_store_flushed_bytes_total", "Bytes written by flushes", lambda: db.flushed_bytes
+    )
+    counter("welcome_store_compactions_total", "Compactions of the store", lambda: db.compactions)
+    counter(
+        "welcome_store_compact_seconds_total", "Time spent compacting", lambda: db.compact_seconds
+    )
+    REGISTRY.callback(
+        "welcome_store_bytes",
+        "Size of the store's files",
+        lambda: {
+            (name[: -len("_bytes")],): value
+            for name, value in db.stats().items()
+            if name.endswith("_bytes") and name != "flushed_bytes"
+        },
+        labels=["file"],
+    )
+    if isinstance(db, storage.SQLiteStore):
+        # The JSON store keeps every key in memory and never reads from disk
+        counter(
+            "welcome_store_disk_reads_total",
+            "Keys read from the database because they weren't cached",
+            lambda: db.disk_reads,
+        )
+        counter(
+            "welcome_store_read_seconds_total",
+            "Time spent reading keys from the database",
+            lambda: db.disk_read_seconds,
+        )
+
+    if isinstance(dispatcher, LaneDispatcher):
+        REGISTRY.callback(
+            "welcome_lane_backlog",
+            "Updates waiting in each lane",
+            lambda: {(lane["lane"],): lane["backlog"] for lane in dispatcher.lane_stats()},
+            labels=["lane"],
+        )
+    if server is not None:
+        counter("welcome_webhook_received_total", "Updates received", lambda: server.received)
+        counter(
+            "welcome_webhook_rejected_total",
+            "Requests with a wrong secret",
+            lambda: server.rejected,
+        )
+        counter(
+            "welcome_webhook_overloaded_total",
+            "Updates refused with 503",
+            lambda: server.overloaded,
+        )
+        counter(
+            "welcome_webhook_malformed_total",
+            "Bodies refused with 400 because they aren't updates",
+            lambda: server.malformed,
+        )
+    if server is not None and server.shards is not None:
+        shards = server.shards
+        REGISTRY.callback("welcome_shards", "Live instances", lambda: len(shards.members))
+        counter(
+            "welcome_shard_forwarded_total",
+            "Updates forwarded to the instance owning their chat",
+            lambda: shards.forwarded,
+        )
+        counter(
+            "welcome_shard_duplicates_total",
+            "Updates another instance had already claimed",
+            lambda: shards.duplicates,
+        )
+        counter(
+            "welcome_shard_rebalances_total",
+            "Changes of the hash ring",
+            lambda: shards.rebalances,
+        )
+
+def create_updater(args):
+    """Creates the Updater, with a LaneDispatcher if more than one lane is wanted"""
+    # Every thread that may talk to Telegram at once needs a connection
+    con_pool_size = SEND_WORKERS + AUTO_DELETE_WORKERS + max(args.lanes, 4) + 4
+    if args.lanes <= 1:
+        return Updater(
+            TOKEN,
+            base_url=args.base_url,
+            request_kwargs={"con_pool_size": con_pool_size},
+        )
+
+    bot = ExtBot(TOKEN, args.base_url, request=Request(con_pool_size=con_pool_size))
+    job_queue = JobQueue()
+    dispatcher = LaneDispatcher(
+        bot,
+        Queue(),
+        job_queue=job_queue,
+        lanes=args.lanes,
+        max_backlog=LANE_MAX_BACKLOG,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+def run_broadcast(text):
+    """Runs a broadcast from the command line until it is done or interrupted"""
+    if not broadcasts.start(text or None):
+        sender.stop()
+        db.close()
+        if text:
+            sys.exit("Another broadcast isn't finished yet, resume it with --broadcast")
+        sys.exit("There is no broadcast to resume")
+    try:
+        while broadcasts.running():
+            sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping the broadcast, run --broadcast again to resume it")
+    broadcasts.stop()
+    sender.stop()
+    db.close()
+
 def main() -> None:
     """Start the bot."""
+    global sender
+    args = parse_args()
+    if SHARD_ID and not (args.webhook and isinstance(db, storage.SQLiteStore)):
+        sys.exit("Sharding needs webhook mode and a sqlite: DATABASE shared by all instances")
+
     # Create the Updater and pass it your bot's token.
-    updater = Updater(TOKEN)
+    updater = create_updater(args)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
+    # Before all other handlers
+    dispatcher.add_handler(TypeHandler(Update, drop_handled), group=-1)
     dispatcher.add_handler(CommandHandler("start", help))
     dispatcher.add_handler(CommandHandler("help", help))
     dispatcher.add_handler(CommandHandler("welcome", set_welcome))
@@ -542,29 +1430,96 @@ def main() -> None:
     dispatcher.add_handler(CommandHandler("unlock", unlock))
     dispatcher.add_handler(CommandHandler("quiet", quiet))
     dispatcher.add_handler(CommandHandler("unquiet", unquiet))
+    dispatcher.add_handler(CommandHandler("batch", batch))
+    dispatcher.add_handler(CommandHandler("unbatch", unbatch))
+    dispatcher.add_handler(CommandHandler("autodelete", autodelete))
     dispatcher.add_handler(CommandHandler("lock", lock))
     dispatcher.add_handler(CommandHandler("receive_reports", receive_reports))
     dispatcher.add_handler(CommandHandler("stop_reports", stop_reports))
     dispatcher.add_handler(CommandHandler("report", report))
+    dispatcher.add_handler(CommandHandler("broadcast", broadcast))
     # Keep track of which chats the bot is in
     dispatcher.add_handler(ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
     dispatcher.add_handler(CommandHandler("show_chats", show_chats))
+    dispatcher.add_handler(CallbackQueryHandler(show_chats_page, pattern=r"^chats:(\d+)$"))
 
     # Handle members joining/leaving chats.
     dispatcher.add_handler(ChatMemberHandler(greet_chat_members, ChatMemberHandler.CHAT_MEMBER))
 
     dispatcher.add_error_handler(error)
+    # After the other handlers
+    dispatcher.add_handler(TypeHandler(Update, first_update), group=1)
+
+    # Delete the bot's messages once they are due
+    updater.job_queue.run_repeating(delete_messages, AUTO_DELETE_INTERVAL)
+    updater.job_queue.run_repeating(save_update_filter, DEDUP_SAVE_INTERVAL)
 
     # Start the Bot
     # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
     # To reset this, simply pass `allowed_updates=[]`
-    updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    if args.asyncio:
+        sender = AsyncSendScheduler(
+            global_rate=SEND_GLOBAL_RATE,
+            group_rate=SEND_GROUP_RATE / 60,
+            connections=SEND_CONNECTIONS,
+        )
+    sender.on_error = send_failed
+    sender.start(updater.bot)
+    broadcasts.sender = sender
+    broadcasts.on_failed = broadcast_failed
+    if args.broadcast is not None:
+        load_state()
+        run_broadcast(args.broadcast)
+        return
+    startup.TIMER.done("handlers")
+
+    broadcasts.on_progress = broadcast_progress
+    server = None
+    metrics_server = None
+    if args.webhook:
+        server = start_webhook(updater, args)
+    else:
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        if args.metrics_port:
+            metrics_server = MetricsServer(REGISTRY, WEBHOOK_LISTEN, args.metrics_port)
+            metrics_server.start()
+    register_metrics(updater, server)
+    if MAINTENANCE_INTERVAL:
+        updater.job_queue.run_repeating(
+            maintain,
+            MAINTENANCE_INTERVAL,
+            context=server.shards if server is not None else None,
+        )
+    startup.TIMER.done("start webhook" if args.webhook else "start polling")
+    load_state()
+    startup.TIMER.done("load store")
+    logger.info("Started: %s", startup.TIMER.report())
+    # Pick up a broadcast the last run didn't finish
+    if broadcasts.start():
+        logger.info("Resuming the unfinished broadcast")
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    # Write out everything that is still buffered
+    broadcasts.stop()
+    if server is not None:
+        server.stop()
+        if server.shards is not None:
+            # The instance taking over our chats must read their latest
+            # settings, and caches them until the next rebalance
+            db.flush()
+            server.shards.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    sender.stop()
+    deletions.stop()
+    deletions.save()
+    update_filter.save()
+    db.close()
+
 
 if __name__ == "__main__":
     main()